@@ -0,0 +1,91 @@
+"""
+Benchmark comparing content repo clone strategies.
+
+Builds a local bare repository shaped roughly like a content repo (JSON pages plus large binary images, with history
+in which the images are replaced several times), then clones it over file:// with each strategy and reports the time
+taken and the size of the resulting checkout on disk.
+
+Usage: python benchmarks/clone_benchmark.py [--files 200] [--image-size 200000] [--commits 10]
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from git_logic import build_clone_options, clone_repo, sparse_checkout  # noqa: E402
+
+STRATEGIES = [
+    ("full clone", build_clone_options(), None),
+    ("partial (blob:none)", build_clone_options("blob:none"), None),
+    ("shallow (depth 1)", build_clone_options(depth=1), None),
+    ("partial + shallow", build_clone_options("blob:none", 1), None),
+    ("partial + sparse (*.json)", build_clone_options("blob:none") + ["--no-checkout"], ["*.json"]),
+]
+
+
+def git(*args, cwd=None):
+    subprocess.run(["git", *args], cwd=cwd, capture_output=True, check=True, text=True)
+
+
+def build_fixture(path, files, image_size, commits):
+    work = f"{path}/work"
+    git("init", "-q", "-b", "master", work)
+    for commit in range(commits):
+        for i in range(files):
+            os.makedirs(f"{work}/content/page_{i % 20}", exist_ok=True)
+            with open(f"{work}/content/page_{i % 20}/page_{i}.json", "w") as f:
+                f.write(f'{{"id": "page_{i}", "type": "isaacQuestionPage", "revision": {commit}}}\n')
+            # Images are rewritten every commit, so the full history holds `commits` copies of each
+            with open(f"{work}/content/page_{i % 20}/figure_{i}.png", "wb") as f:
+                f.write(os.urandom(image_size))
+        git("add", "-A", cwd=work)
+        git("-c", "user.name=bench", "-c", "user.email=bench@example.com", "commit", "-q", "-m", f"Commit {commit}", cwd=work)
+    bare = f"{path}/content.git"
+    git("clone", "-q", "--bare", work, bare)
+    # Allow partial clones from the fixture, as GitHub does
+    git("config", "uploadpack.allowFilter", "true", cwd=bare)
+    git("config", "uploadpack.allowAnySHA1InWant", "true", cwd=bare)
+    shutil.rmtree(work)
+    return bare
+
+
+def disk_usage(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            file_path = os.path.join(root, name)
+            if not os.path.islink(file_path):
+                total += os.path.getsize(file_path)
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=200)
+    parser.add_argument("--image-size", type=int, default=200000, help="Size of each image in bytes")
+    parser.add_argument("--commits", type=int, default=10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f"Building fixture: {args.files} pages and images, {args.commits} commits...")
+        bare = build_fixture(tmp, args.files, args.image_size, args.commits)
+        print(f"Fixture size: {disk_usage(bare) / 1e6:.1f}MB\n")
+
+        for name, options, sparse_patterns in STRATEGIES:
+            target = f"{tmp}/clone"
+            start = time.perf_counter()
+            clone_repo(f"file://{bare}", target, options)
+            if sparse_patterns:
+                sparse_checkout(target, sparse_patterns)
+            elapsed = time.perf_counter() - start
+            print(f"{name:<28} {elapsed:6.2f}s {disk_usage(target) / 1e6:8.1f}MB")
+            shutil.rmtree(target)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Micro-benchmark for the job queue database layer.
+
+Runs a number of concurrent writer processes enqueueing jobs, then a number of concurrent runner processes claiming
+them, against a throwaway database, and reports operations per second for each phase.
+
+Usage: python benchmarks/db_benchmark.py [--writers 4] [--runners 2] [--jobs 2000]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from multiprocessing import Process, Queue
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from constants import JobType  # noqa: E402
+from db_logic import init_db, enqueue_job, get_next_job  # noqa: E402
+
+
+def enqueue_worker(count, results):
+    start = time.perf_counter()
+    for i in range(count):
+        enqueue_job(JobType.ISSUE, data={"issue_number": i, "script_name": "image_list", "subject": "phy", "arguments": []})
+    results.put(time.perf_counter() - start)
+
+
+def claim_worker(results):
+    start = time.perf_counter()
+    claimed = 0
+    while get_next_job(f"benchmark:{os.getpid()}") is not None:
+        claimed += 1
+    results.put((claimed, time.perf_counter() - start))
+
+
+def run_phase(target, args, processes):
+    results = Queue()
+    workers = [Process(target=target, args=(*args, results)) for _ in range(processes)]
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    outputs = [results.get() for _ in workers]
+    for w in workers:
+        w.join()
+    return outputs, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--runners", type=int, default=2)
+    parser.add_argument("--jobs", type=int, default=2000, help="Jobs enqueued per writer")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # JOB_DB_PATH is relative, so running from a temporary directory gives us a fresh database
+        os.chdir(tmp)
+        init_db()
+
+        _, elapsed = run_phase(enqueue_worker, (args.jobs,), args.writers)
+        total = args.writers * args.jobs
+        print(f"enqueue: {total} jobs from {args.writers} writers in {elapsed:.2f}s ({total / elapsed:.0f} ops/s)")
+
+        outputs, elapsed = run_phase(claim_worker, (), args.runners)
+        claimed = sum(c for c, _ in outputs)
+        print(f"claim:   {claimed} jobs by {args.runners} runners in {elapsed:.2f}s ({claimed / elapsed:.0f} ops/s)")
+        if claimed != total:
+            print(f"WARNING: claimed {claimed} jobs but {total} were enqueued")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Benchmark showing how enqueue latency scales with the size of the job_queue table.
+
+For each table size, the table is bulk-filled with finished jobs and then the time taken by enqueue_job is measured
+over a number of samples. Latency should stay flat as the table grows.
+
+Usage: python benchmarks/enqueue_scaling_benchmark.py [--sizes 100 10000 100000 1000000] [--samples 200]
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from constants import JobType, JobRunStatus  # noqa: E402
+from db_connection import transaction  # noqa: E402
+from db_logic import init_db, enqueue_job  # noqa: E402
+
+FILL_BATCH_SIZE = 10000
+
+
+def fill_table(current_size, target_size):
+    data = json.dumps({"issue_number": 1, "script_name": "image_list", "subject": "phy", "arguments": []})
+    while current_size < target_size:
+        batch = min(FILL_BATCH_SIZE, target_size - current_size)
+        with transaction() as conn:
+            conn.executemany('''
+            INSERT INTO job_queue (id, job_type, status, job_data)
+            VALUES (?, ?, ?, ?)
+            ''', ((str(uuid.uuid4()), JobType.ISSUE, JobRunStatus.FINISHED, data) for _ in range(batch)))
+        current_size += batch
+    return current_size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 10000, 100000, 1000000])
+    parser.add_argument("--samples", type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # JOB_DB_PATH is relative, so running from a temporary directory gives us a fresh database
+        os.chdir(tmp)
+        init_db()
+
+        size = 0
+        for target in sorted(args.sizes):
+            size = fill_table(size, target)
+            timings = []
+            for i in range(args.samples):
+                start = time.perf_counter()
+                enqueue_job(JobType.ISSUE, data={"issue_number": i, "script_name": "image_list", "subject": "phy", "arguments": []})
+                timings.append((time.perf_counter() - start) * 1000)
+            size += args.samples
+            timings.sort()
+            print(f"{target:>9} rows: median {statistics.median(timings):.3f}ms, "
+                  f"p95 {timings[int(len(timings) * 0.95) - 1]:.3f}ms, max {timings[-1]:.3f}ms")
+
+
+if __name__ == "__main__":
+    main()
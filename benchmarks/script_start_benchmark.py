@@ -0,0 +1,87 @@
+"""
+Benchmark comparing how long scripts take to start cold (a fresh interpreter) and warm (forked from the fork server).
+
+Writes a trivial script that imports the modules the fork server preloads (as the real scripts do) and parses its
+arguments, then runs it a number of times each way and reports the time from asking for the script to be started to it
+having finished. As the script itself does next to nothing, this is the start-up cost a job pays.
+
+Usage: python benchmarks/script_start_benchmark.py [--runs 50]
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from constants import DEFAULT_SCRIPT_LIMITS, SCRIPT_FORKSERVER_PRELOAD_MODULES  # noqa: E402
+from script_process import ScriptForkServer, start_cold_script  # noqa: E402
+
+SCRIPT = """
+import argparse
+for module in {modules!r}:
+    try:
+        __import__(module)
+    except ImportError:
+        pass
+parser = argparse.ArgumentParser()
+parser.add_argument("-j", "--job_id")
+parser.add_argument("--subject")
+args = parser.parse_args()
+print(f"Job {{args.job_id}} for {{args.subject}}")
+"""
+
+
+def time_runs(start, runs, script_path, log_dir):
+    times = []
+    for i in range(runs):
+        with open(f"{log_dir}/stdout", "wb") as stdout, open(f"{log_dir}/stderr", "wb") as stderr:
+            begin = time.perf_counter()
+            process = start(script_path, ["-j", str(i), "--subject", "phy"], stdout, stderr, dict(os.environ),
+                            DEFAULT_SCRIPT_LIMITS)
+            process.wait()
+            times.append(time.perf_counter() - begin)
+        if process.returncode != 0:
+            with open(f"{log_dir}/stderr") as f:
+                raise RuntimeError(f"Benchmark script failed: {f.read()}")
+    return times
+
+
+def report(name, times):
+    times = sorted(times)
+    p95 = times[min(len(times) - 1, int(len(times) * 0.95))]
+    print(f"{name:<6} mean {statistics.mean(times) * 1000:7.1f}ms  median {statistics.median(times) * 1000:7.1f}ms  "
+          f"p95 {p95 * 1000:7.1f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        script_path = f"{tmp}/benchmark_script.py"
+        with open(script_path, "w") as f:
+            f.write(SCRIPT.format(modules=SCRIPT_FORKSERVER_PRELOAD_MODULES))
+
+        cold = time_runs(start_cold_script, args.runs, script_path, tmp)
+
+        forkserver = ScriptForkServer(f"{tmp}/forkserver.sock")
+        begin = time.perf_counter()
+        forkserver.start(logger=print)
+        print(f"Fork server took {(time.perf_counter() - begin) * 1000:.1f}ms to start (once, when the runner starts)\n")
+        try:
+            warm = time_runs(forkserver.run, args.runs, script_path, tmp)
+        finally:
+            forkserver.stop()
+
+        print(f"{args.runs} runs each:")
+        report("cold", cold)
+        report("warm", warm)
+        print(f"\nWarm starts are {statistics.median(cold) / statistics.median(warm):.1f}x faster (median)")
+
+
+if __name__ == "__main__":
+    main()
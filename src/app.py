@@ -1,3 +1,5 @@
+import base64
+import binascii
 import hashlib
 import hmac
 import logging
@@ -9,12 +11,25 @@ from flask import Flask, request, jsonify
 from werkzeug.exceptions import HTTPException, default_exceptions
 
 from script_manager import SCRIPTS
-from db_logic import enqueue_job, get_job_info, get_job_count, get_job_ids_by_status, get_job_by_issue_number, \
-    reset_job, update_job_status
+from db_logic import enqueue_job, get_job_info, get_job_output, get_job_status_summary, get_job_ids_by_status, \
+    get_job_by_issue_number, reset_job, update_job_status, cancel_job
 from constants import *
+from job_logs import read_job_log
+from job_notify import notify_job_runner
+from git_logic import add_comment_to_issue
+from github_auth import get_github_token
 
 app = Flask(__name__)
 
+# The job id lists returned by /queue-status, keyed by the status they list
+QUEUE_STATUS_LISTS = {
+    JobRunStatus.PENDING: "pending_jobs",
+    JobRunStatus.RUNNING: "running_jobs",
+    JobRunStatus.PAUSED: "paused_jobs",
+    JobRunStatus.FINISHED: "finished_jobs",
+    JobRunStatus.FAILED: "failed_jobs",
+}
+
 
 # --- Validation ---
 
@@ -27,6 +42,10 @@ def validate_script_name(script_name: str):
     return script_name and re.match("[a-z_]", script_name)
 
 
+def validate_status(status: str):
+    return status in QUEUE_STATUS_LISTS
+
+
 def verify_signature(payload, signature):
     secret = os.getenv("GITHUB_WEBHOOK_SECRET")
     if not secret:
@@ -37,11 +56,23 @@ def verify_signature(payload, signature):
 
 # --- API endpoints ---
 
+# Query parameters (all optional):
+#  - output: if "true", include the script result (finished jobs) or error (failed jobs) - otherwise only its size
+#  - offset, length: the range of characters of the result/error to return
 @app.route('/status/<job_id>', methods=['GET'])
 def status(job_id):
     if not validate_job_id(job_id):
         return jsonify({"error": "Invalid job_id"}), 400
 
+    include_output = request.args.get("output", "false").lower() == "true"
+    try:
+        offset = int(request.args.get("offset", 0))
+        length = int(request.args["length"]) if "length" in request.args else None
+    except ValueError:
+        return jsonify({"error": "Invalid offset or length"}), 400
+    if offset < 0 or (length is not None and length < 0):
+        return jsonify({"error": "Invalid offset or length"}), 400
+
     job_info = get_job_info(job_id)
 
     app.logger.info(job_info)
@@ -57,14 +88,26 @@ def status(job_id):
     except KeyError:
         return jsonify({"error": "Invalid job type"}), 500
 
-    # Add result if job is finished, or error if job failed
+    # Add result if job is finished, or error if job failed. These are stored separately from the job, so are only
+    # fetched if asked for.
+    output_kind = None
     if job_info["status"] == JobRunStatus.FINISHED:
-        response["result"] = job_info["result"]
+        output_kind = "result"
         # Add output file path if it exists
         if "output_file" in job_info and job_info["output_file"]:
             response["output_file"] = job_info["output_file"]
-    elif job_info["status"] == JobRunStatus.FAILED and "error" in job_info and job_info["error"]:
-        response["error"] = job_info["error"]
+    elif job_info["status"] == JobRunStatus.FAILED:
+        output_kind = "error"
+    if output_kind and f"{output_kind}_size" in job_info:
+        response[f"{output_kind}_size"] = job_info[f"{output_kind}_size"]
+        if include_output:
+            output = get_job_output(job_id, output_kind, offset=offset, length=length)
+            if output:
+                response[output_kind] = output["body"]
+                response[f"{output_kind}_truncated"] = offset + len(output["body"]) < output["size"] or offset > 0
+
+    if job_info.get("stop_reason"):
+        response["stop_reason"] = job_info["stop_reason"]
 
     # Add timestamps and durations if they exist
     for key in ["enqueued_at", "executed_at"]:
@@ -77,17 +120,126 @@ def status(job_id):
     return jsonify(response)
 
 
-@app.route('/queue-status', methods=['GET'])
-def queue_status():
+# The output of a job's script so far, read from its log file (see job_logs.py) - so can be polled while the script runs.
+# Query parameters (all optional):
+#  - stream: "stdout" (the default) or "stderr"
+#  - offset: the byte to start reading from - pass the previous response's next_offset to read on from there
+#  - limit: the maximum number of bytes to return
+@app.route('/status/<job_id>/log', methods=['GET'])
+def job_log(job_id):
+    if not validate_job_id(job_id):
+        return jsonify({"error": "Invalid job_id"}), 400
+
+    stream = request.args.get("stream", "stdout")
+    if stream not in JOB_LOG_STREAMS:
+        return jsonify({"error": f"Invalid stream, must be one of {', '.join(JOB_LOG_STREAMS)}"}), 400
+    try:
+        offset = int(request.args.get("offset", 0))
+        limit = int(request.args.get("limit", JOB_LOG_READ_DEFAULT_LIMIT))
+    except ValueError:
+        return jsonify({"error": "Invalid offset or limit"}), 400
+    if offset < 0 or limit < 1:
+        return jsonify({"error": "Invalid offset or limit"}), 400
+    limit = min(limit, JOB_LOG_READ_MAX_LIMIT)
+
+    log = read_job_log(job_id, stream, offset=offset, limit=limit)
+    if log is None:
+        return jsonify({"error": "Cannot locate a log for that job_id"}), 404
+
+    job_info = get_job_info(job_id)
     return jsonify({
-        "queue_size": get_job_count(),
-        "pending_jobs": get_job_ids_by_status(JobRunStatus.PENDING),
-        "running_jobs": get_job_ids_by_status(JobRunStatus.RUNNING),
-        "finished_jobs": get_job_ids_by_status(JobRunStatus.FINISHED),
-        "failed_jobs": get_job_ids_by_status(JobRunStatus.FAILED),
+        "stream": stream,
+        "offset": offset,
+        "next_offset": log["next_offset"],
+        "size": log["size"],
+        "data": log["data"],
+        # The log won't grow any more once the job has finished (unless it is rerun)
+        "complete": job_info is not None and job_info["status"] in [JobRunStatus.FINISHED, JobRunStatus.FAILED],
     })
 
 
+# Cancel a job: a running job's script is stopped, and a job that hasn't started (or is waiting for arguments) is failed.
+# Optionally takes a JSON body with the `reason`, which is recorded in the job.
+@app.route('/cancel/<job_id>', methods=['POST'])
+def cancel(job_id):
+    if not validate_job_id(job_id):
+        return jsonify({"error": "Invalid job_id"}), 400
+
+    reason = (request.get_json(silent=True) or {}).get("reason", "Cancelled by an administrator")
+    status = cancel_job(job_id, reason)
+    if status is None:
+        return jsonify({"error": "Cannot locate an unfinished job with that job_id"}), 404
+    app.logger.info(f"Cancelled job {job_id} ({status}): {reason}")
+    if status == JobRunStatus.RUNNING:
+        return jsonify({"message": "Job is being stopped", "status": status})
+    return jsonify({"message": "Job cancelled", "status": status})
+
+
+# Cursors are opaque to clients - they encode the (enqueued_at, id) of the last job on the previous page
+def encode_cursor(enqueued_at, job_id):
+    return base64.urlsafe_b64encode(f"{enqueued_at}|{job_id}".encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    try:
+        enqueued_at, job_id = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8").split("|")
+    except (binascii.Error, UnicodeError, ValueError):
+        return None
+    return enqueued_at, job_id
+
+
+# Query parameters (all optional):
+#  - limit: the maximum number of job ids to return per status
+#  - status: only list jobs with this status (e.g. PENDING)
+#  - cursor: the `next_cursors` value from a previous response, to fetch the next page of ids for `status`
+#  - ages: if "true", include the age in seconds of the oldest pending, running and paused jobs
+@app.route('/queue-status', methods=['GET'])
+def queue_status():
+    try:
+        limit = int(request.args.get("limit", QUEUE_STATUS_DEFAULT_LIMIT))
+    except ValueError:
+        return jsonify({"error": "Invalid limit"}), 400
+    if not 0 < limit <= QUEUE_STATUS_MAX_LIMIT:
+        return jsonify({"error": f"limit must be between 1 and {QUEUE_STATUS_MAX_LIMIT}"}), 400
+
+    status_filter = request.args.get("status")
+    if status_filter is not None and not validate_status(status_filter):
+        return jsonify({"error": "Invalid status"}), 400
+
+    after = None
+    if "cursor" in request.args:
+        if status_filter is None:
+            return jsonify({"error": "A cursor can only be used together with status"}), 400
+        after = decode_cursor(request.args["cursor"])
+        if after is None:
+            return jsonify({"error": "Invalid cursor"}), 400
+
+    summary = get_job_status_summary()
+    response = {
+        "queue_size": sum(s["count"] for s in summary.values()),
+        "status_counts": {status: summary.get(status, {"count": 0})["count"] for status in QUEUE_STATUS_LISTS},
+        "runner_concurrency": JOB_RUNNER_CONCURRENCY,
+        "next_cursors": {},
+    }
+
+    for status, list_name in QUEUE_STATUS_LISTS.items():
+        if status_filter is not None and status != status_filter:
+            continue
+        page = get_job_ids_by_status(status, limit, after=after)
+        response[list_name] = [job_id for _, job_id in page]
+        # Only hand out a cursor if there may be more jobs to fetch
+        response["next_cursors"][list_name] = encode_cursor(*page[-1]) if len(page) == limit else None
+
+    if request.args.get("ages", "false").lower() == "true":
+        response["oldest_ages"] = {
+            status: str(int(summary[status]["oldest_age"])) + "s"
+            for status in [JobRunStatus.PENDING, JobRunStatus.RUNNING, JobRunStatus.PAUSED]
+            if status in summary and summary[status]["oldest_age"] is not None
+        }
+
+    return jsonify(response)
+
+
 @app.route('/list-scripts', methods=['GET'])
 def list_scripts():
     return jsonify(SCRIPTS)
@@ -98,9 +250,11 @@ def log():
     if not request.is_json:
         return jsonify({"error": "Invalid request format"}), 400
     json = request.get_json()
-    # Log whatever is in the `message` field
-    app.logger.info(json["message"])
-    return jsonify({"message": "Logged"})
+    # Log whatever is in the `message` field, or each of the `messages`, so many lines can be sent in one request
+    messages = json["messages"] if "messages" in json else [json["message"]]
+    for message in messages:
+        app.logger.info(message)
+    return jsonify({"message": "Logged", "count": len(messages)})
 
 # --- Webhook endpoint ---
 # The only one that really matters, the rest are just for testing and admin purposes. This should be the only one
@@ -117,6 +271,11 @@ def webhook():
         return jsonify({"error": "Invalid request format"}), 200
 
     json = request.get_json()
+
+    # Pushes to the content or scripts repos: ask the job runner to sync its copy in the background
+    if request.headers.get("X-GitHub-Event") == "push":
+        return handle_push(json)
+
     if "issue" not in json:
         return jsonify({"error": "Invalid request format"}), 200
 
@@ -150,7 +309,22 @@ def webhook():
         command_search = re.search(r"^Please (.*)$", json["comment"]["body"])
         if command_search:
             command = command_search.group(1).lower()
-            if command in ["run", "rerun", "restart", "re-run", "re-start"]:
+            # The "fresh" commands run read scripts again even if nothing has changed (see result_cache.py)
+            use_cache = command not in RERUN_FRESH_COMMANDS
+            if command in CANCEL_COMMANDS:
+                if job:
+                    app.logger.info(f"Cancelling job {job['id']} for issue {json['issue']['number']}")
+                    reason = f"Cancelled by @{json['comment']['user']['login']} on the issue"
+                    # A running job's runner comments once it has stopped the script, but nothing else will answer for
+                    # a job that hadn't started
+                    if cancel_job(job["id"], reason) == JobRunStatus.FAILED:
+                        try:
+                            add_comment_to_issue(get_github_token(), json["issue"]["number"],
+                                                 f"### Job cancelled\n\n> {reason}\n\nComment `Please rerun` to run it again.")
+                        except Exception as e:
+                            app.logger.error(f"Failed to comment on issue {json['issue']['number']}: {e}")
+                return jsonify({"message": "Webhook received, command processed"}), 200
+            if command in ["run", "rerun", "restart", "re-run", "re-start"] + RERUN_FRESH_COMMANDS:
                 if job:
                     # Reset the job
                     app.logger.info(f"Rerunning issue {json['issue']['number']}, new job id {job['id']}. Script name: {job['script_name']}, subject: {job['subject']}")
@@ -160,7 +334,8 @@ def webhook():
                         "create_pull_request": job["create_pull_request"],
                         "script_name": job["script_name"],
                         "subject": job["subject"],
-                        "arguments": []
+                        "arguments": [],
+                        "use_cache": use_cache,
                     })
                 else:
                     script_name = re.search(r"#*\s?Script name\n*(.*)", json["issue"]["body"]).group(1)
@@ -173,7 +348,8 @@ def webhook():
                         "create_pull_request": create_pr,
                         "script_name": script_name,
                         "subject": "ada" if site == "Ada CS" else "phy",
-                        "arguments": []
+                        "arguments": [],
+                        "use_cache": use_cache,
                     })
             return jsonify({"message": "Webhook received, command processed"}), 200
 
@@ -203,6 +379,16 @@ def webhook():
     return jsonify({"message": "Webhook received"}), 200
 
 
+def handle_push(json):
+    repo_name = json.get("repository", {}).get("full_name")
+    repo_paths = [path for path, url in REPO_URL_MAP.items() if url == repo_name]
+    if not repo_paths or json.get("ref") != "refs/heads/master":
+        return jsonify({"message": "Ignoring push"}), 200
+    app.logger.info(f"Push to master of {repo_name}, requesting sync of {repo_paths[0]}")
+    notify_job_runner(f"{JOB_NOTIFY_SYNC_PREFIX}{repo_paths[0]}")
+    return jsonify({"message": "Webhook received, sync requested"}), 200
+
+
 # --- Error handling ---
 
 def _make_json_error(ex):
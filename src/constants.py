@@ -1,6 +1,8 @@
 """
 Configuration constants for the scripts runner, and related enums.
 """
+import os
+
 class JobType:
     ISSUE = "ISSUE"
     ISSUE_COMMENT = "ISSUE_COMMENT"
@@ -18,7 +20,8 @@ class PushChangesStatus:
     FAILED = "FAILED"
 
 SCRIPTS_PATH = r"./data/isaac-scripts"
-SCRIPT_DISPATCHER_SCRIPTS_SUBDIR = f"{SCRIPTS_PATH}/script-dispatcher"
+# The scripts live in this folder of the scripts repo
+SCRIPT_DISPATCHER_SUBDIR_NAME = "script-dispatcher"
 DATA_PATH = r"./data"
 PHY_DATA_PATH = r"./data/rutherford-content"
 CS_DATA_PATH = r"./data/ada-content"
@@ -26,7 +29,11 @@ DATA_PATH_MAP = {
     "phy": PHY_DATA_PATH,
     "ada": CS_DATA_PATH,
 }
+WORKTREE_PATH = r"./data/worktrees"
 OUTPUT_PATH = r"./output"
+# Scripts find the checkout of the content repo they should use (a per-job worktree, for write scripts that opt in) in
+# this variable
+CONTENT_PATH_ENV_VAR = "SCRIPT_DISPATCHER_CONTENT_PATH"
 INPUT_PATH = r"./input"
 KEY_PATH = r"./key.pem"
 
@@ -38,11 +45,178 @@ CONTENT_REPO_PATH_MAP = {
     "ada": r"isaacphysics/ada-content"
 }
 SCRIPTS_REPO_PATH = r"isaacphysics/isaac-scripts"
+# The GitHub repository each local checkout is a clone of
+REPO_URL_MAP = {
+    SCRIPTS_PATH: SCRIPTS_REPO_PATH,
+    PHY_DATA_PATH: CONTENT_REPO_PATH_MAP["phy"],
+    CS_DATA_PATH: CONTENT_REPO_PATH_MAP["ada"],
+}
 
 BOT_USERNAME = "isaac-script-dispatcher[bot]"
 BOT_EMAIL = "129531963+isaac-script-dispatcher[bot]@users.noreply.github.com"
 
-NO_JOB_SLEEP_TIME = 5
+# The web workers wake the job runner up through this socket when there is new work (see job_notify.py). The runner
+# also polls the queue every JOB_FALLBACK_POLL_INTERVAL seconds in case a notification is missed.
+JOB_NOTIFY_SOCKET_PATH = r"./job_runner.sock"
+JOB_NOTIFY_NEW_JOB = "job"
+JOB_NOTIFY_SYNC_PREFIX = "sync:"  # followed by the path of the repo to sync
+JOB_NOTIFY_CANCEL_PREFIX = "cancel:"  # followed by the id of the running job to cancel
+JOB_NOTIFY_MAX_MESSAGE_SIZE = 1024
+JOB_FALLBACK_POLL_INTERVAL = 60
+
+# Job fields that are stored in the job_output table rather than in job_data, as they can be very large
+JOB_OUTPUT_KINDS = ["result", "error"]
+
+QUEUE_STATUS_DEFAULT_LIMIT = 50
+QUEUE_STATUS_MAX_LIMIT = 500
+
+ENQUEUE_JOB_ID_ATTEMPTS = 5
+
+# How the (large) content repos are cloned: CONTENT_CLONE_FILTER is passed to `git clone --filter` ("blob:none" makes a
+# partial clone, which only downloads file contents as they are needed) and CONTENT_CLONE_DEPTH to `git clone --depth`
+# (a shallow clone). Either can be turned off by setting the environment variable to an empty string.
+CONTENT_CLONE_FILTER = os.getenv("CONTENT_CLONE_FILTER", "blob:none") or None
+CONTENT_CLONE_DEPTH = int(os.getenv("CONTENT_CLONE_DEPTH") or 0) or None
+
+# A repo synced with its remote less than this many seconds ago is assumed to still be up to date
+REPO_FRESHNESS_WINDOW = 60
+# The job runner syncs the repos in the background whenever GitHub tells us (via a push webhook) that one has changed,
+# and every REPO_SYNC_INTERVAL seconds in case a webhook is missed
+REPO_SYNC_INTERVAL = 5 * 60
+# A sync waiting for a repo's write lock lets new jobs read from the repo in the meantime, but only for this many seconds
+# - after that they wait for it too, so that it can't be put off forever (see ReadWriteLock)
+REPO_SYNC_LOCK_PRIORITY_AFTER = 10 * 60
+# A job fails rather than waiting longer than this many seconds for a sync of a repo it uses
+REPO_SYNC_WAIT_TIMEOUT = 30 * 60
+# Timeouts (in seconds) for git commands: ones that talk to GitHub, ones that update a checkout's working tree, and
+# clones (which fetch the whole repo)
+GIT_NETWORK_TIMEOUT = 10 * 60
+GIT_CHECKOUT_TIMEOUT = 10 * 60
+GIT_CLONE_TIMEOUT = 60 * 60
+
+# The number of jobs the job runner will run at once
+JOB_RUNNER_CONCURRENCY = int(os.getenv("JOB_RUNNER_CONCURRENCY", "2"))
+# Jobs waiting for a repo lock don't count towards JOB_RUNNER_CONCURRENCY (see script_checkout), but the runner claims no
+# more than this many jobs on top of it
+JOB_RUNNER_MAX_WAITING_JOBS = int(os.getenv("JOB_RUNNER_MAX_WAITING_JOBS", "4"))
+
+# A claimed job is leased to its runner for JOB_LEASE_DURATION seconds, and the runner renews the lease every
+# JOB_LEASE_RENEW_INTERVAL seconds while the job runs. If the runner dies, the lease expires and the job is re-queued.
+JOB_LEASE_DURATION = 300
+JOB_LEASE_RENEW_INTERVAL = 60
+
+# SQLite connection tuning for the job queue database (see db_connection.py)
+DB_BUSY_TIMEOUT = 30  # seconds to wait on a locked database before giving up
+DB_SYNCHRONOUS = "NORMAL"  # Safe with WAL - a power loss can only roll back the most recent transactions
+DB_CACHED_STATEMENTS = 128
+DB_AUTO_VACUUM_INCREMENTAL = 2  # The value of PRAGMA auto_vacuum for INCREMENTAL mode
+DB_INCREMENTAL_VACUUM_PAGES = 500  # Free pages to reclaim per incremental vacuum step
+
+# Finished and failed jobs older than JOB_RETENTION_DAYS are moved from job_queue to the archive database by the job
+# runner, which checks every JOB_HOUSEKEEPING_INTERVAL seconds and moves JOB_ARCHIVE_BATCH_SIZE jobs per transaction
+JOB_ARCHIVE_DB_PATH = r"job_archive.db"
+JOB_RETENTION_DAYS = 30
+JOB_HOUSEKEEPING_INTERVAL = 60 * 60
+JOB_ARCHIVE_BATCH_SIZE = 100
+
+# GitHub REST API client (see github_client.py). Requests that fail with a server error or hit a secondary rate limit
+# are retried up to GITHUB_MAX_RETRIES times, backing off exponentially from GITHUB_RETRY_BACKOFF seconds unless GitHub
+# says how long to wait (Retry-After / X-RateLimit-Reset). No single wait is longer than GITHUB_MAX_RETRY_WAIT seconds.
+GITHUB_API_URL = "https://api.github.com"
+GITHUB_API_VERSION = "2022-11-28"
+GITHUB_REQUEST_TIMEOUT = 30
+GITHUB_POOL_SIZE = 10
+GITHUB_MAX_RETRIES = 3
+GITHUB_RETRY_BACKOFF = 1
+GITHUB_MAX_RETRY_WAIT = 60
+GITHUB_RETRY_STATUS_CODES = [500, 502, 503, 504]
+# A request that failed with a server error may have been carried out anyway, so only requests that are safe to repeat
+# are retried after one: those made with these methods, and others that ask for it (see GitHubClient.request)
+GITHUB_IDEMPOTENT_METHODS = ["GET", "HEAD", "OPTIONS", "PUT", "DELETE"]
+
+# The GitHub App installation token is cached in memory by the job runner (see github_auth.py), and refreshed in the
+# background once it has less than GITHUB_TOKEN_REFRESH_MARGIN seconds left to run. A token with less than
+# GITHUB_TOKEN_MIN_VALIDITY seconds left is never handed out. Failed refreshes are retried every
+# GITHUB_TOKEN_RETRY_INTERVAL seconds.
+GITHUB_TOKEN_REFRESH_MARGIN = 10 * 60
+GITHUB_TOKEN_MIN_VALIDITY = 5 * 60
+GITHUB_TOKEN_RETRY_INTERVAL = 30
+# git gets the token from this environment variable through a credential helper configured in each repo, rather than
+# having it written into the repos' remote URLs. Installation tokens authenticate with the username x-access-token.
+GIT_TOKEN_ENV_VAR = "SCRIPT_DISPATCHER_GIT_TOKEN"
+GIT_CREDENTIAL_HELPER = f'!f() {{ test "$1" = get && echo username=x-access-token && echo "password=${GIT_TOKEN_ENV_VAR}"; }}; f'
+
+# Output files of read scripts are uploaded to REPO_PATH in a single commit (see upload_files_to_github): blobs are
+# created GITHUB_UPLOAD_CONCURRENCY at a time, with each file streamed from disk in chunks of GITHUB_UPLOAD_CHUNK_SIZE
+# bytes (a multiple of 3, so each chunk base64-encodes without padding). If master moves while the commit is being
+# made, it is rebuilt on the new master up to GITHUB_REF_UPDATE_ATTEMPTS times.
+GITHUB_UPLOAD_CONCURRENCY = 4
+GITHUB_UPLOAD_CHUNK_SIZE = 3 * 256 * 1024
+GITHUB_REF_UPDATE_ATTEMPTS = 3
+
+# Before a read script's output files are uploaded (see output_artifacts.py), any file of at least
+# OUTPUT_COMPRESSION_THRESHOLD bytes is gzipped (unless it is already in a compressed format), and any file whose
+# contents have been uploaded before links to the earlier upload instead of being uploaded again
+OUTPUT_COMPRESSION_THRESHOLD = int(os.getenv("OUTPUT_COMPRESSION_THRESHOLD", str(1024 * 1024)))
+OUTPUT_COMPRESSED_EXTENSIONS = [".gz", ".zip", ".bz2", ".xz", ".png", ".jpg", ".jpeg", ".gif", ".webp", ".mp4", ".pdf"]
+
+# Read scripts' results (their output, and output files) are saved under RESULT_CACHE_PATH, keyed on everything the
+# result depends on (see result_cache.py), and reused while none of that changes. The least recently used results are
+# evicted once they take up more than RESULT_CACHE_MAX_SIZE bytes.
+RESULT_CACHE_PATH = r"./data/result_cache"
+RESULT_CACHE_MAX_SIZE = int(os.getenv("RESULT_CACHE_MAX_SIZE", str(1024 * 1024 * 1024)))
+# Issue comments ("Please <command>") that run a job again without using a cached result
+RERUN_FRESH_COMMANDS = ["rerun fresh", "run fresh", "re-run fresh", "refresh"]
+
+# Scripts marked "incremental" in SCRIPTS are told what has changed in the content repo since they last ran successfully
+# (with the same arguments) through these environment variables - see incremental_runs.py
+PREVIOUS_SHA_ENV_VAR = "SCRIPT_DISPATCHER_PREVIOUS_SHA"
+CURRENT_SHA_ENV_VAR = "SCRIPT_DISPATCHER_CURRENT_SHA"
+CHANGES_PATH_ENV_VAR = "SCRIPT_DISPATCHER_CHANGES_PATH"
+PREVIOUS_OUTPUT_PATH_ENV_VAR = "SCRIPT_DISPATCHER_PREVIOUS_OUTPUT_PATH"
+
+# An index of the content repo (pages, tags, links and figures) is built for each content commit under
+# CONTENT_INDEX_PATH, and scripts are given the path of the one for the commit they run against through
+# CONTENT_INDEX_PATH_ENV_VAR - see content_index.py. Only the newest CONTENT_INDEX_KEEP indexes per subject are kept.
+CONTENT_INDEX_PATH = r"./data/content_index"
+CONTENT_INDEX_PATH_ENV_VAR = "SCRIPT_DISPATCHER_CONTENT_INDEX_PATH"
+CONTENT_INDEX_KEEP = 3
+
+# Scripts' stdout and stderr are written to files under JOB_LOG_PATH as they run (see job_logs.py), rather than held in
+# memory. Only the last JOB_LOG_TAIL_SIZE bytes are kept as the job's result/error, and only the last
+# ISSUE_COMMENT_OUTPUT_LENGTH characters are posted in the issue comment - the full output is uploaded as a file if it is
+# longer than that. Logs are deleted along with their jobs, after JOB_RETENTION_DAYS.
+JOB_LOG_PATH = r"./logs"
+JOB_LOG_STREAMS = ["stdout", "stderr"]
+JOB_LOG_TAIL_SIZE = 64 * 1024
+JOB_LOG_READ_DEFAULT_LIMIT = 64 * 1024
+JOB_LOG_READ_MAX_LIMIT = 1024 * 1024
+ISSUE_COMMENT_OUTPUT_LENGTH = 10000
+FULL_OUTPUT_FILE_NAME = "script_output.log"
+
+# Limits on a script's run, which can be overridden for a script with a "limits" entry in SCRIPTS (see
+# get_script_limits): "timeout" is the wall-clock time allowed in seconds, "cpu_time" the CPU time in seconds, "memory"
+# the address space in bytes, and "max_output" the largest file (including its output log) it may write, in bytes. A
+# script that goes over one is killed, along with any processes it started.
+DEFAULT_SCRIPT_LIMITS = {
+    "timeout": 2 * 60 * 60,
+    "cpu_time": 2 * 60 * 60,
+    "memory": 4 * 1024 * 1024 * 1024,
+    "max_output": 1024 * 1024 * 1024,
+}
+SCRIPT_CPU_TIME_GRACE = 5  # seconds between a script being told it is out of CPU time and being killed outright
+# How often a running script is checked on, and how often the database is checked for the job having been cancelled
+# (in case the runner missed the notification)
+SCRIPT_POLL_INTERVAL = 1
+JOB_STOP_CHECK_INTERVAL = 10
+# Issue comments ("Please <command>") that cancel the issue's job
+CANCEL_COMMANDS = ["cancel", "stop"]
 
-GET_NEXT_JOB_RETRIES = 10
-GET_NEXT_JOB_RETRY_DELAY = 1
+# Scripts are started by forking a warm interpreter that has already imported these modules (see script_process.py),
+# unless they opt out with "warm": False in SCRIPTS. Any that aren't installed are skipped.
+SCRIPT_FORKSERVER_SOCKET_PATH = r"./script_forkserver.sock"
+SCRIPT_FORKSERVER_PRELOAD_MODULES = [
+    "argparse", "csv", "json", "re", "pathlib", "urllib.request", "xml.dom.minidom",
+    "dateutil.parser", "requests", "scour.scour",
+]
+SCRIPT_FORKSERVER_MAX_MESSAGE_SIZE = 1024 * 1024
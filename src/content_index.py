@@ -0,0 +1,245 @@
+"""
+Index of the content repos, shared by the scripts.
+
+Most scripts (list_question_data, question_list, topics_concepts, link_checker, image_list, ...) start by walking the
+whole content repo and parsing every JSON page, only to look up a few fields of each. Instead, the job runner builds an
+index of each content commit once, and gives scripts that opt in with "content_index": True in SCRIPTS its path in
+CONTENT_INDEX_PATH_ENV_VAR (other scripts don't wait for it to be built). The index is a SQLite database with these
+tables:
+
+- files (path, blob_sha): every file in the commit
+- pages (path, id, type, title, error): every JSON file, with `error` set (and the rest NULL) if it isn't valid JSON
+- tags (path, tag): the tags of each page
+- links (path, kind, target): what each page links to - `kind` is "markdown" or "html" for links in its text, "url"
+  for "url" fields, or "related" for the ids in "relatedContent"
+- figures (path, src, resolved_path): the figures and images each page uses, with `resolved_path` the path in the repo
+  that `src` refers to (NULL for external URLs)
+
+Paths are relative to the root of the repo. An index is never changed once it is built, so scripts can open it with
+`sqlite3.connect(f"file:{path}?immutable=1", uri=True)` (and e.g. `PRAGMA mmap_size` to memory-map it) without any
+locking. Each index is built from the previous one, re-parsing only the files whose contents have changed.
+
+The index describes the commit the script's checkout started at, so write scripts must not rely on it after changing
+the content. If the index can't be built, the environment variable isn't set and scripts must walk the repo as before.
+"""
+import glob
+import json
+import os
+import posixpath
+import re
+import sqlite3
+import subprocess
+import threading
+import time
+from contextlib import closing
+
+from constants import *
+from git_logic import get_commit_sha
+
+# Bumped whenever the schema or what is indexed changes, so that older indexes aren't built on
+CONTENT_INDEX_VERSION = 1
+
+CONTENT_INDEX_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+    CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, blob_sha TEXT NOT NULL);
+    CREATE TABLE IF NOT EXISTS pages (path TEXT PRIMARY KEY, id TEXT, type TEXT, title TEXT, error TEXT);
+    CREATE INDEX IF NOT EXISTS pages_id ON pages (id);
+    CREATE INDEX IF NOT EXISTS pages_type ON pages (type);
+    CREATE TABLE IF NOT EXISTS tags (path TEXT NOT NULL, tag TEXT NOT NULL);
+    CREATE INDEX IF NOT EXISTS tags_path ON tags (path);
+    CREATE INDEX IF NOT EXISTS tags_tag ON tags (tag);
+    CREATE TABLE IF NOT EXISTS links (path TEXT NOT NULL, kind TEXT NOT NULL, target TEXT NOT NULL);
+    CREATE INDEX IF NOT EXISTS links_path ON links (path);
+    CREATE INDEX IF NOT EXISTS links_target ON links (target);
+    CREATE TABLE IF NOT EXISTS figures (path TEXT NOT NULL, src TEXT NOT NULL, resolved_path TEXT);
+    CREATE INDEX IF NOT EXISTS figures_path ON figures (path);
+    CREATE INDEX IF NOT EXISTS figures_resolved_path ON figures (resolved_path);
+'''
+
+MARKDOWN_LINK_PATTERN = re.compile(r"\[[^\]]*\]\(\s*<?([^)\s>]+)")
+HTML_REFERENCE_PATTERN = re.compile(r"""\b(href|src)\s*=\s*["']([^"']+)["']""")
+EXTERNAL_URL_PATTERN = re.compile(r"^([a-z][a-z0-9+.-]*:|//)", re.IGNORECASE)
+
+# Only one index is built at a time for each subject, so concurrent jobs wait for it rather than building it twice
+content_index_locks = {subject: threading.Lock() for subject in DATA_PATH_MAP}
+
+
+def get_content_index_path(subject, content_sha):
+    return f"{CONTENT_INDEX_PATH}/{subject}/{content_sha}-v{CONTENT_INDEX_VERSION}.sqlite"
+
+
+# The path of the index of the commit checked out at `content_path` (a checkout of the `subject` content repo),
+# building it first if it doesn't exist yet
+def get_content_index(subject, content_path, logger=lambda x: None):
+    content_sha = get_commit_sha(content_path, "HEAD")
+    index_path = get_content_index_path(subject, content_sha)
+    with content_index_locks[subject]:
+        if not os.path.exists(index_path):
+            build_content_index(subject, content_path, content_sha, logger=logger)
+    return index_path
+
+
+# The blob SHA of every file in commit `content_sha`, by path. Only reads trees, so doesn't need the files checked out.
+def list_files(content_path, content_sha):
+    result = subprocess.run(
+        ["git", "-C", content_path, "ls-tree", "-r", "-z", content_sha],
+        capture_output=True,
+        check=True,
+        text=True,
+    )
+    files = {}
+    for entry in result.stdout.split("\0"):
+        if not entry:
+            continue
+        info, path = entry.split("\t", 1)
+        _, object_type, blob_sha = info.split(" ")
+        # Submodules are listed as commits
+        if object_type == "blob":
+            files[path] = blob_sha
+    return files
+
+
+# Yield the contents of each of the blobs `blob_shas`, in order, through a single `git cat-file` process
+def read_blobs(content_path, blob_shas):
+    process = subprocess.Popen(
+        ["git", "-C", content_path, "cat-file", "--batch"],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+    )
+    try:
+        for blob_sha in blob_shas:
+            # cat-file flushes its output after each object, so asking for one at a time can't deadlock
+            process.stdin.write(f"{blob_sha}\n".encode())
+            process.stdin.flush()
+            header = process.stdout.readline().decode().split()
+            if len(header) != 3:
+                raise Exception(f"Failed to read blob {blob_sha}: {' '.join(header)}")
+            content = process.stdout.read(int(header[2]))
+            process.stdout.read(1)
+            yield content
+    finally:
+        process.stdin.close()
+        process.stdout.close()
+        process.wait()
+
+
+# Collect the links and figures in `value` (part of a page, under `key`) into `links` and `figures`
+def collect_references(value, links, figures, key=None):
+    if isinstance(value, dict):
+        for child_key, child in value.items():
+            collect_references(child, links, figures, child_key)
+    elif isinstance(value, list):
+        for child in value:
+            collect_references(child, links, figures, key)
+    elif isinstance(value, str):
+        if key == "src":
+            figures.append(value)
+        elif key == "url":
+            links.append(("url", value))
+        elif key == "relatedContent":
+            links.append(("related", value))
+        else:
+            for match in MARKDOWN_LINK_PATTERN.finditer(value):
+                links.append(("markdown", match.group(1)))
+            for attribute, target in HTML_REFERENCE_PATTERN.findall(value):
+                if attribute == "src":
+                    figures.append(target)
+                else:
+                    links.append(("html", target))
+
+
+# The path in the repo that `src`, used by the page at `page_path`, refers to, or None if it is an external URL
+def resolve_figure_path(page_path, src):
+    if EXTERNAL_URL_PATTERN.match(src):
+        return None
+    src = src.split("#")[0].split("?")[0]
+    if src.startswith("/"):
+        return posixpath.normpath(src.lstrip("/"))
+    return posixpath.normpath(posixpath.join(posixpath.dirname(page_path), src))
+
+
+def text_or_none(value):
+    return value if isinstance(value, str) else None
+
+
+def index_page(conn, path, content):
+    try:
+        page = json.loads(content)
+    except ValueError as e:
+        conn.execute("INSERT INTO pages (path, error) VALUES (?, ?)", (path, str(e)))
+        return
+    if not isinstance(page, dict):
+        conn.execute("INSERT INTO pages (path) VALUES (?)", (path,))
+        return
+
+    conn.execute(
+        "INSERT INTO pages (path, id, type, title) VALUES (?, ?, ?, ?)",
+        (path, text_or_none(page.get("id")), text_or_none(page.get("type")), text_or_none(page.get("title"))),
+    )
+    tags = page.get("tags")
+    if isinstance(tags, list):
+        conn.executemany("INSERT INTO tags (path, tag) VALUES (?, ?)", [(path, tag) for tag in tags if isinstance(tag, str)])
+    links, figures = [], []
+    collect_references(page, links, figures)
+    conn.executemany("INSERT INTO links (path, kind, target) VALUES (?, ?, ?)", [(path, kind, target) for kind, target in links])
+    conn.executemany("INSERT INTO figures (path, src, resolved_path) VALUES (?, ?, ?)",
+                     [(path, src, resolve_figure_path(path, src)) for src in figures])
+
+
+# The newest index of an earlier commit, to build the next one from, or None if there isn't one
+def get_previous_content_index(subject):
+    index_paths = glob.glob(f"{CONTENT_INDEX_PATH}/{subject}/*-v{CONTENT_INDEX_VERSION}.sqlite")
+    return max(index_paths, key=os.path.getmtime, default=None)
+
+
+def build_content_index(subject, content_path, content_sha, logger=lambda x: None):
+    start = time.monotonic()
+    index_path = get_content_index_path(subject, content_sha)
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    # Build the index to one side and move it into place, so scripts never see a half-built one
+    temp_path = f"{index_path}.tmp"
+    if os.path.exists(temp_path):
+        os.unlink(temp_path)
+    previous_index_path = get_previous_content_index(subject)
+    if previous_index_path:
+        with closing(sqlite3.connect(f"file:{previous_index_path}?immutable=1", uri=True)) as previous, \
+                closing(sqlite3.connect(temp_path)) as temp:
+            previous.backup(temp)
+
+    conn = sqlite3.connect(temp_path, isolation_level=None)
+    try:
+        # Nothing reads the index until it is moved into place, so there is no need for a journal
+        conn.execute("PRAGMA journal_mode = OFF")
+        conn.execute("PRAGMA synchronous = OFF")
+        conn.executescript(CONTENT_INDEX_SCHEMA)
+        conn.execute("BEGIN")
+        indexed_files = dict(conn.execute("SELECT path, blob_sha FROM files"))
+        files = list_files(content_path, content_sha)
+        changed = [path for path, blob_sha in files.items() if indexed_files.get(path) != blob_sha]
+        removed = [path for path in indexed_files if path not in files]
+        for table in ["files", "pages", "tags", "links", "figures"]:
+            conn.executemany(f"DELETE FROM {table} WHERE path = ?", [(path,) for path in changed + removed])
+        conn.executemany("INSERT INTO files (path, blob_sha) VALUES (?, ?)", [(path, files[path]) for path in changed])
+
+        pages = [path for path in changed if path.endswith(".json")]
+        for path, content in zip(pages, read_blobs(content_path, [files[path] for path in pages])):
+            index_page(conn, path, content)
+        conn.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                         [("content_sha", content_sha), ("version", str(CONTENT_INDEX_VERSION))])
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+    os.replace(temp_path, index_path)
+
+    built_from = f"from the index of {os.path.basename(previous_index_path)[:7]}" if previous_index_path else "from scratch"
+    logger(f"Built the {subject} content index for {content_sha[:7]} {built_from} in {time.monotonic() - start:.1f}s "
+           f"({len(changed)} files changed, {len(removed)} removed, {len(pages)} pages parsed)")
+    remove_old_content_indexes(subject, logger=logger)
+
+
+def remove_old_content_indexes(subject, keep=CONTENT_INDEX_KEEP, logger=lambda x: None):
+    # Scripts that already have an old index open can carry on using it after it is removed
+    index_paths = sorted(glob.glob(f"{CONTENT_INDEX_PATH}/{subject}/*.sqlite"), key=os.path.getmtime, reverse=True)
+    for index_path in index_paths[keep:]:
+        logger(f"Removing old content index {index_path}")
+        os.unlink(index_path)
@@ -0,0 +1,67 @@
+"""
+Shared connection layer for the job queue (and job archive) databases.
+
+Connections are cached per process and per thread, so each gunicorn worker and the job runner reuse a single
+connection (and its prepared statement cache) instead of opening the database file for every query. The database is
+kept in WAL mode so that readers never block the writer and vice versa.
+"""
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from constants import *
+
+_local = threading.local()
+
+
+def _connect(path):
+    # isolation_level=None puts the connection in autocommit mode: reads don't hold a transaction open, and writes that
+    # need more than one statement go through transaction() below.
+    conn = sqlite3.connect(
+        path,
+        timeout=DB_BUSY_TIMEOUT,
+        isolation_level=None,
+        cached_statements=DB_CACHED_STATEMENTS,
+    )
+    conn.row_factory = sqlite3.Row
+    conn.execute(f"PRAGMA busy_timeout = {int(DB_BUSY_TIMEOUT * 1000)}")
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute(f"PRAGMA synchronous = {DB_SYNCHRONOUS}")
+    return conn
+
+
+def _get_connections():
+    # A connection must never be used on both sides of a fork (gunicorn forks its workers and the job runner after
+    # on_starting has touched the database), so the cache is keyed on the process id as well as the thread.
+    if getattr(_local, "pid", None) != os.getpid():
+        _local.connections = {}
+        _local.pid = os.getpid()
+    return _local.connections
+
+
+def get_connection(path=JOB_DB_PATH):
+    connections = _get_connections()
+    if path not in connections:
+        connections[path] = _connect(path)
+    return connections[path]
+
+
+def close_connection(path=JOB_DB_PATH):
+    conn = _get_connections().pop(path, None)
+    if conn is not None:
+        conn.close()
+
+
+@contextmanager
+def transaction(path=JOB_DB_PATH):
+    # BEGIN IMMEDIATE takes the write lock up front, so the transaction waits (up to busy_timeout) for other writers
+    # rather than failing part way through with "database is locked".
+    conn = get_connection(path)
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
@@ -1,18 +1,18 @@
 import json
+import os
 import sqlite3
 import time
 import uuid
+import zlib
 
 from constants import *
+from db_connection import get_connection, transaction
+from db_migrations import migrate, enable_incremental_vacuum, create_archive_tables
+from job_notify import notify_job_runner
 
 
-def generate_unique_job_id():
-    conn = sqlite3.connect(JOB_DB_PATH)
-    existing_uuids = map(lambda x: x[0], conn.execute('SELECT id FROM job_queue').fetchall())
-    new_uuid = str(uuid.uuid4())
-    while new_uuid in existing_uuids:
-        new_uuid = str(uuid.uuid4())
-    return new_uuid
+def generate_job_id():
+    return str(uuid.uuid4())
 
 
 def translate_job_to_dict(row):
@@ -29,191 +29,455 @@ def translate_job_to_dict(row):
     return job_dict
 
 
-def init_db():
-    conn = sqlite3.connect(JOB_DB_PATH)
-    c = conn.cursor()
-    c.execute('''
-    CREATE TABLE IF NOT EXISTS job_queue (
-        id TEXT PRIMARY KEY,
-        job_type TEXT NOT NULL,
-        job_data JSON DEFAULT NULL,
-        status TEXT NOT NULL,
-        enqueued_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-        executed_at DATETIME DEFAULT NULL,
-        run_duration DATETIME DEFAULT NULL,
-        wait_duration DATETIME DEFAULT NULL
-    )
-    ''')
-    c.execute('''
-    CREATE TABLE IF NOT EXISTS app_token (
-        token TEXT PRIMARY KEY,
-        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-        expires_at DATETIME DEFAULT NULL
-    )
-    ''')
-    conn.commit()
-    conn.close()
+def init_db(logger=lambda x: None):
+    migrate(logger=logger)
+    enable_incremental_vacuum(logger=logger)
+    # The archive is only created when jobs are first archived, but one that already exists may need new columns
+    if os.path.exists(JOB_ARCHIVE_DB_PATH):
+        with transaction(JOB_ARCHIVE_DB_PATH) as archive:
+            create_archive_tables(archive)
 
 
+# Job ids are random UUIDs, so rather than checking for an existing id up front we rely on the PRIMARY KEY constraint
+# and simply retry with a new id in the (astronomically unlikely) event of a collision
 def enqueue_job(job_type, data=None):
-    job_id = generate_unique_job_id()
-    conn = sqlite3.connect(JOB_DB_PATH)
-    c = conn.cursor()
-    if data is None:
-        c.execute('''
-        INSERT INTO job_queue (id, job_type, status)
-        VALUES (?, ?, ?, ?)
-        ''', (job_id, job_type, JobRunStatus.PENDING))
-    else:
-        c.execute('''
-        INSERT INTO job_queue (id, job_type, status, job_data)
-        VALUES (?, ?, ?, ?)
-        ''', (job_id, job_type, JobRunStatus.PENDING, json.dumps(data)))
-    conn.commit()
-    conn.close()
-    return job_id
-
-
-def update_job_status(job_id, new_status, data=None, logger=lambda x: None):
+    conn = get_connection()
+    job_data = json.dumps(data) if data is not None else None
+    for _ in range(ENQUEUE_JOB_ID_ATTEMPTS):
+        job_id = generate_job_id()
+        try:
+            conn.execute('''
+            INSERT INTO job_queue (id, job_type, status, job_data)
+            VALUES (?, ?, ?, ?)
+            ''', (job_id, job_type, JobRunStatus.PENDING, job_data))
+            notify_job_runner()
+            return job_id
+        except sqlite3.IntegrityError:
+            continue
+    raise Exception(f"Failed to generate a unique job id after {ENQUEUE_JOB_ID_ATTEMPTS} attempts")
+
+
+# Set the status of job `job_id`, along with its data and output. If `worker_id` is given, only does so if the job is still
+# claimed by that runner. Returns whether the job was updated.
+def update_job_status(job_id, new_status, data=None, logger=lambda x: None, worker_id=None):
     if new_status == JobRunStatus.FAILED:
         logger(f"Job {job_id} failed: {data['error'] if data and 'error' in data else '[no error message]'}")
 
     if new_status == JobRunStatus.RUNNING:
         raise ValueError("Cannot set job status to RUNNING. Use get_next_job instead.")
     else:
-        conn = sqlite3.connect(JOB_DB_PATH)
-        c = conn.cursor()
-        c.execute('''
-                UPDATE job_queue
-                SET status = ?, run_duration = ROUND((JULIANDAY(CURRENT_TIMESTAMP) - JULIANDAY(executed_at)) * 86400.0), job_data = json_patch(COALESCE(job_data, json('{}')), json(?))
-                WHERE id = ?
-                ''', (new_status, json.dumps(data if data else {}), job_id))
-        conn.commit()
-        conn.close()
+        # Script output and errors go in the job_output table; the job row just records their size
+        job_data = dict(data) if data else {}
+        outputs = {kind: str(job_data.pop(kind)) for kind in JOB_OUTPUT_KINDS if job_data.get(kind) is not None}
+        for kind, body in outputs.items():
+            job_data[f"{kind}_size"] = len(body)
+
+        # A cancellation that came in too late to stop a job that finished doesn't apply to it
+        clear_stop_reason = ", stop_reason = NULL" if new_status == JobRunStatus.FINISHED else ""
+        claimed_by_check, params = ("AND claimed_by = ?", (worker_id,)) if worker_id is not None else ("", ())
+        with transaction() as conn:
+            updated = conn.execute(f'''
+                    UPDATE job_queue
+                    SET status = ?, run_duration = ROUND((JULIANDAY(CURRENT_TIMESTAMP) - JULIANDAY(executed_at)) * 86400.0), job_data = json_patch(COALESCE(job_data, json('{{}}')), json(?)),
+                        claimed_by = NULL, lease_expires_at = NULL{clear_stop_reason}
+                    WHERE id = ? {claimed_by_check}
+                    RETURNING id
+                    ''', (new_status, json.dumps(job_data), job_id, *params)).fetchall()
+            if not updated:
+                return False
+            for kind, body in outputs.items():
+                conn.execute('''
+                INSERT OR REPLACE INTO job_output (job_id, kind, body, size)
+                VALUES (?, ?, ?, ?)
+                ''', (job_id, kind, body, len(body)))
+        if new_status == JobRunStatus.PENDING:
+            notify_job_runner()
+        return True
 
 
 def reset_job(job_id, data=None):
-    conn = sqlite3.connect(JOB_DB_PATH)
-    c = conn.cursor()
-    c.execute('''
-    UPDATE job_queue
-    SET status = ?,  executed_at = NULL, run_duration = NULL, wait_duration = NULL, job_data = json(?), enqueued_at = CURRENT_TIMESTAMP
-    WHERE id = ?
-    ''', (JobRunStatus.PENDING, json.dumps(data if data else {}), job_id))
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        conn.execute('''
+        UPDATE job_queue
+        SET status = ?,  executed_at = NULL, run_duration = NULL, wait_duration = NULL, job_data = json(?), enqueued_at = CURRENT_TIMESTAMP,
+            claimed_by = NULL, lease_expires_at = NULL, stop_reason = NULL
+        WHERE id = ?
+        ''', (JobRunStatus.PENDING, json.dumps(data if data else {}), job_id))
+        # Any output from the previous run no longer applies
+        conn.execute('''
+        DELETE FROM job_output
+        WHERE job_id = ?
+        ''', (job_id,))
+    notify_job_runner()
     return job_id
 
 
 def get_job_info(job_id):
-    conn = sqlite3.connect(JOB_DB_PATH)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute('''
-    SELECT id, job_type, job_data, status, enqueued_at, executed_at, run_duration, wait_duration
+    conn = get_connection()
+    result = conn.execute('''
+    SELECT id, job_type, job_data, status, enqueued_at, executed_at, run_duration, wait_duration, stop_reason
     FROM job_queue
     WHERE id = ?
-    ''', (job_id,))
-    result = c.fetchone()
-    conn.close()
+    ''', (job_id,)).fetchone()
+    if result is None:
+        return get_archived_job_info(job_id)
     return translate_job_to_dict(result)
 
 
+# Fetch (part of) a job's stored output of the given kind (see JOB_OUTPUT_KINDS). `offset` and `length` are in
+# characters. Returns None if the job has no output of that kind.
+def get_job_output(job_id, kind, offset=0, length=None):
+    conn = get_connection()
+    result = conn.execute('''
+    SELECT SUBSTR(body, ?, COALESCE(?, size)) AS body, size
+    FROM job_output
+    WHERE job_id = ? AND kind = ?
+    ''', (offset + 1, length, job_id, kind)).fetchone()
+    if result is None:
+        return get_archived_job_output(job_id, kind, offset=offset, length=length)
+    return {"body": result["body"], "size": result["size"]}
+
+
 def get_job_by_issue_number(issue_number):
-    conn = sqlite3.connect(JOB_DB_PATH)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute('''
-    SELECT id, job_type, job_data, status, enqueued_at, executed_at, run_duration, wait_duration
+    conn = get_connection()
+    result = conn.execute('''
+    SELECT id, job_type, job_data, status, enqueued_at, executed_at, run_duration, wait_duration, stop_reason
     FROM job_queue
-    WHERE job_type = 'ISSUE' AND json_extract(job_data, '$.issue_number') = ? AND status != 'FINISHED'
-    ''', (issue_number,))
-    result = c.fetchone()
-    conn.close()
+    WHERE job_type = 'ISSUE' AND issue_number = ? AND status != 'FINISHED'
+    ''', (issue_number,)).fetchone()
     return translate_job_to_dict(result)
 
 
-def get_next_job():
-    conn = sqlite3.connect(JOB_DB_PATH)
-    conn.row_factory = sqlite3.Row
-    conn.isolation_level = 'EXCLUSIVE'
+# Atomically claim the oldest pending job for `worker_id`, leasing it for JOB_LEASE_DURATION seconds. Jobs left RUNNING
+# by a runner whose lease has expired (e.g. because it crashed) are claimable again, so they are picked back up here.
+def get_next_job(worker_id=None):
+    conn = get_connection()
+    # Fetch all rows so the statement is finished (and so committed) before we return
+    result = conn.execute(f'''
+    UPDATE job_queue
+    SET status = '{JobRunStatus.RUNNING}', claimed_by = ?, lease_expires_at = DATETIME(CURRENT_TIMESTAMP, ?),
+        wait_duration = ROUND((JULIANDAY(CURRENT_TIMESTAMP) - JULIANDAY(enqueued_at)) * 86400.0), executed_at = CURRENT_TIMESTAMP
+    WHERE id = (
+        SELECT id
+        FROM job_queue
+        WHERE status = '{JobRunStatus.PENDING}'
+           OR (status = '{JobRunStatus.RUNNING}' AND (lease_expires_at IS NULL OR lease_expires_at < CURRENT_TIMESTAMP))
+        ORDER BY enqueued_at ASC
+        LIMIT 1
+    )
+    RETURNING *
+    ''', (worker_id, f"+{JOB_LEASE_DURATION} seconds")).fetchall()
+    return translate_job_to_dict(result[0]) if result else None
+
+
+# Ask for job `job_id` to be stopped, giving the `reason`. A job that hasn't started, or is waiting for arguments, is
+# failed there and then (returning FAILED); a running job has the reason recorded, and its runner is notified and stops
+# its script (see job_queue.py), returning RUNNING. Returns None if there is no unfinished job `job_id`.
+def cancel_job(job_id, reason):
+    error = f"Cancelled: {reason}"
+    with transaction() as conn:
+        # Failing the job is a single statement, so a runner can't claim it in between it being checked and failed
+        failed = conn.execute(f'''
+        UPDATE job_queue
+        SET status = '{JobRunStatus.FAILED}', stop_reason = ?, job_data = json_patch(COALESCE(job_data, json('{{}}')), json(?))
+        WHERE id = ? AND status IN ('{JobRunStatus.PENDING}', '{JobRunStatus.PAUSED}')
+        RETURNING id
+        ''', (reason, json.dumps({"error_size": len(error)}), job_id)).fetchall()
+        if failed:
+            conn.execute('''
+            INSERT OR REPLACE INTO job_output (job_id, kind, body, size)
+            VALUES (?, 'error', ?, ?)
+            ''', (job_id, error, len(error)))
+            return JobRunStatus.FAILED
+
+        running = conn.execute(f'''
+        UPDATE job_queue
+        SET stop_reason = ?
+        WHERE id = ? AND status = '{JobRunStatus.RUNNING}'
+        RETURNING id
+        ''', (reason, job_id)).fetchall()
+    if not running:
+        return None
+    notify_job_runner(f"{JOB_NOTIFY_CANCEL_PREFIX}{job_id}")
+    return JobRunStatus.RUNNING
 
-    for attempt in range(GET_NEXT_JOB_RETRIES):
-        try:
-            c = conn.cursor()
-            c.execute(f"SELECT * FROM job_queue WHERE status = '{JobRunStatus.PENDING}' ORDER BY enqueued_at ASC LIMIT 1")
-            job = c.fetchone()
-
-            if job is not None:
-                job_id = job['id']
-                c.execute(f'''
-                UPDATE job_queue 
-                SET status = '{JobRunStatus.RUNNING}', wait_duration = ROUND((JULIANDAY(CURRENT_TIMESTAMP) - JULIANDAY(enqueued_at)) * 86400.0), executed_at = CURRENT_TIMESTAMP WHERE id = ?
-                ''', (job_id,))
-                conn.commit()
-                conn.close()
-                return translate_job_to_dict(job)
-
-            break
-        except sqlite3.OperationalError as e:
-            if str(e) == "database is locked":
-                print(f"Attempt {attempt + 1}: Database is locked. Retrying in {GET_NEXT_JOB_RETRY_DELAY} seconds...")
-                time.sleep(GET_NEXT_JOB_RETRY_DELAY)
-            else:
-                raise e
-    else:
-        print("Failed to get the next job after multiple attempts.")
-    conn.close()
+
+# Record why job `job_id` was stopped - only if it is still claimed by `worker_id`, if that is given
+def set_job_stop_reason(job_id, reason, worker_id=None):
+    conn = get_connection()
+    claimed_by_check, params = ("AND claimed_by = ?", (worker_id,)) if worker_id is not None else ("", ())
+    conn.execute(f'''
+    UPDATE job_queue
+    SET stop_reason = ?
+    WHERE id = ? {claimed_by_check}
+    ''', (reason, job_id, *params))
 
 
-def get_job_ids_by_status(status):
-    conn = sqlite3.connect(JOB_DB_PATH)
-    c = conn.cursor()
-    c.execute('''
-    SELECT id
+def get_job_stop_reason(job_id):
+    conn = get_connection()
+    result = conn.execute('''
+    SELECT stop_reason
     FROM job_queue
-    WHERE status = ?
-    ''', (status,))
-    result = c.fetchall()
-    conn.close()
-    return [r[0] for r in result]
-
-
-def get_job_count():
-    conn = sqlite3.connect(JOB_DB_PATH)
-    c = conn.cursor()
-    c.execute('''
-    SELECT COUNT(id)
+    WHERE id = ?
+    ''', (job_id,)).fetchone()
+    return result["stop_reason"] if result else None
+
+
+# Extend the lease on a running job. Returns False if the job is no longer leased to `worker_id` (e.g. the lease
+# expired and another runner has claimed it), in which case the caller should stop working on it.
+def renew_job_lease(job_id, worker_id):
+    conn = get_connection()
+    result = conn.execute(f'''
+    UPDATE job_queue
+    SET lease_expires_at = DATETIME(CURRENT_TIMESTAMP, ?)
+    WHERE id = ? AND claimed_by = ? AND status = '{JobRunStatus.RUNNING}'
+    ''', (f"+{JOB_LEASE_DURATION} seconds", job_id, worker_id))
+    return result.rowcount == 1
+
+
+# Per-status job counts, and the enqueue time of the oldest job with each status, in a single pass over the
+# (status, enqueued_at) index
+def get_job_status_summary():
+    conn = get_connection()
+    result = conn.execute('''
+    SELECT status, COUNT(*) AS count,
+        ROUND((JULIANDAY(CURRENT_TIMESTAMP) - JULIANDAY(MIN(enqueued_at))) * 86400.0) AS oldest_age
+    FROM job_queue
+    GROUP BY status
+    ''').fetchall()
+    return {r["status"]: {"count": r["count"], "oldest_age": r["oldest_age"]} for r in result}
+
+
+# Keyset pagination over the jobs with a given status, in enqueue order. `after` is the (enqueued_at, id) of the last
+# job on the previous page. Returns (enqueued_at, id) pairs so the caller can build the next cursor.
+def get_job_ids_by_status(status, limit, after=None):
+    conn = get_connection()
+    if after is None:
+        result = conn.execute('''
+        SELECT enqueued_at, id
+        FROM job_queue
+        WHERE status = ?
+        ORDER BY enqueued_at, id
+        LIMIT ?
+        ''', (status, limit)).fetchall()
+    else:
+        result = conn.execute('''
+        SELECT enqueued_at, id
+        FROM job_queue
+        WHERE status = ? AND (enqueued_at, id) > (?, ?)
+        ORDER BY enqueued_at, id
+        LIMIT ?
+        ''', (status, after[0], after[1], limit)).fetchall()
+    return [(r["enqueued_at"], r["id"]) for r in result]
+
+
+# --- Retention ---
+
+# Move up to `batch_size` finished or failed jobs enqueued more than `retention_days` ago, and their output, from the
+# live tables to the archive database. Returns the number of jobs archived, so callers can repeat until it returns 0.
+def archive_old_jobs(retention_days=JOB_RETENTION_DAYS, batch_size=JOB_ARCHIVE_BATCH_SIZE):
+    conn = get_connection()
+    jobs = conn.execute(f'''
+    SELECT id, job_type, job_data, status, enqueued_at, executed_at, run_duration, wait_duration, stop_reason
     FROM job_queue
-    ''')
-    result = c.fetchone()
-    conn.close()
-    return result[0]
+    WHERE status IN ('{JobRunStatus.FINISHED}', '{JobRunStatus.FAILED}') AND enqueued_at < DATETIME(CURRENT_TIMESTAMP, ?)
+    LIMIT ?
+    ''', (f"-{retention_days} days", batch_size)).fetchall()
+    if not jobs:
+        return 0
+    job_ids = [job["id"] for job in jobs]
+    placeholders = ", ".join("?" * len(job_ids))
+    outputs = conn.execute(f'''
+    SELECT job_id, kind, body, size
+    FROM job_output
+    WHERE job_id IN ({placeholders})
+    ''', job_ids).fetchall()
+
+    # Write to the archive before deleting from the live tables, so that if we die in between the jobs are in both
+    # databases rather than neither (and will simply be archived again next time)
+    with transaction(JOB_ARCHIVE_DB_PATH) as archive:
+        create_archive_tables(archive)
+        archive.executemany('''
+        INSERT OR REPLACE INTO job_queue_archive (id, job_type, job_data, status, enqueued_at, executed_at, run_duration, wait_duration, stop_reason)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', [tuple(job) for job in jobs])
+        archive.executemany('''
+        INSERT OR REPLACE INTO job_output_archive (job_id, kind, body, size)
+        VALUES (?, ?, ?, ?)
+        ''', [(o["job_id"], o["kind"], zlib.compress(o["body"].encode("utf-8")), o["size"]) for o in outputs])
+
+    with transaction() as conn:
+        conn.execute(f'''
+        DELETE FROM job_output
+        WHERE job_id IN ({placeholders})
+        ''', job_ids)
+        # Re-check the status, in case a job was re-run while we were archiving it
+        conn.execute(f'''
+        DELETE FROM job_queue
+        WHERE id IN ({placeholders}) AND status IN ('{JobRunStatus.FINISHED}', '{JobRunStatus.FAILED}')
+        ''', job_ids)
+    return len(jobs)
+
+
+# Give up to `pages` free pages back to the filesystem. Returns the number of free pages left, so callers can repeat
+# (letting other writers in between steps) until it returns 0.
+def reclaim_free_pages(pages=DB_INCREMENTAL_VACUUM_PAGES):
+    conn = get_connection()
+    # incremental_vacuum frees one page per step of the statement, and execute() only steps it once, so run it
+    # through executescript (sqlite3_exec) which steps it to completion
+    conn.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+    return conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+
+def get_archived_job_info(job_id):
+    if not os.path.exists(JOB_ARCHIVE_DB_PATH):
+        return None
+    archive = get_connection(JOB_ARCHIVE_DB_PATH)
+    result = archive.execute('''
+    SELECT id, job_type, job_data, status, enqueued_at, executed_at, run_duration, wait_duration, stop_reason
+    FROM job_queue_archive
+    WHERE id = ?
+    ''', (job_id,)).fetchone()
+    return translate_job_to_dict(result)
+
+
+def get_archived_job_output(job_id, kind, offset=0, length=None):
+    if not os.path.exists(JOB_ARCHIVE_DB_PATH):
+        return None
+    archive = get_connection(JOB_ARCHIVE_DB_PATH)
+    result = archive.execute('''
+    SELECT body, size
+    FROM job_output_archive
+    WHERE job_id = ? AND kind = ?
+    ''', (job_id, kind)).fetchone()
+    if result is None:
+        return None
+    body = zlib.decompress(result["body"]).decode("utf-8")
+    return {"body": body[offset:offset + length if length is not None else None], "size": result["size"]}
+
+
+# --- Repo sync state ---
+
+def save_repo_sync_state(repo_path, sha, synced_at):
+    conn = get_connection()
+    conn.execute('''
+    INSERT OR REPLACE INTO repo_sync_state (repo_path, sha, synced_at)
+    VALUES (?, ?, ?)
+    ''', (repo_path, sha, synced_at))
+
+
+def get_repo_sync_state(repo_path):
+    conn = get_connection()
+    result = conn.execute('''
+    SELECT sha, synced_at
+    FROM repo_sync_state
+    WHERE repo_path = ?
+    ''', (repo_path,)).fetchone()
+    return dict(result) if result else None
+
+
+# --- Output artifacts ---
+
+def save_output_artifact(content_hash, url, size, uploaded_size):
+    conn = get_connection()
+    conn.execute('''
+    INSERT OR REPLACE INTO output_artifacts (content_hash, url, size, uploaded_size, created_at)
+    VALUES (?, ?, ?, ?, ?)
+    ''', (content_hash, url, size, uploaded_size, time.time()))
+
+
+def get_output_artifact(content_hash):
+    conn = get_connection()
+    result = conn.execute('''
+    SELECT url, size, uploaded_size, created_at
+    FROM output_artifacts
+    WHERE content_hash = ?
+    ''', (content_hash,)).fetchone()
+    return dict(result) if result else None
+
+
+# --- Read script result cache ---
+
+def save_result_cache_entry(cache_key, job_id, script_name, subject, size):
+    conn = get_connection()
+    conn.execute('''
+    INSERT OR REPLACE INTO result_cache (cache_key, job_id, script_name, subject, size, created_at, last_used_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', (cache_key, job_id, script_name, subject, size, time.time(), time.time()))
+
+
+# Look up a cache entry, marking it as just used
+def use_result_cache_entry(cache_key):
+    conn = get_connection()
+    result = conn.execute('''
+    UPDATE result_cache
+    SET last_used_at = ?
+    WHERE cache_key = ?
+    RETURNING job_id, script_name, subject, size, created_at
+    ''', (time.time(), cache_key)).fetchall()
+    return dict(result[0]) if result else None
+
+
+def delete_result_cache_entry(cache_key):
+    conn = get_connection()
+    conn.execute('''
+    DELETE FROM result_cache
+    WHERE cache_key = ?
+    ''', (cache_key,))
+
+
+# The keys of the least recently used cache entries that don't fit in `max_size` bytes, after all the more recently
+# used ones
+def get_result_cache_keys_over_budget(max_size):
+    conn = get_connection()
+    result = conn.execute('''
+    SELECT cache_key
+    FROM (
+        SELECT cache_key, SUM(size) OVER (ORDER BY last_used_at DESC, cache_key) AS cumulative_size
+        FROM result_cache
+    )
+    WHERE cumulative_size > ?
+    ''', (max_size,)).fetchall()
+    return [row["cache_key"] for row in result]
+
+
+# --- Incremental script runs ---
+
+def save_script_run(script_name, subject, arguments_hash, content_sha, job_id):
+    conn = get_connection()
+    conn.execute('''
+    INSERT OR REPLACE INTO script_runs (script_name, subject, arguments_hash, content_sha, job_id, completed_at)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ''', (script_name, subject, arguments_hash, content_sha, job_id, time.time()))
+
+
+def get_last_script_run(script_name, subject, arguments_hash):
+    conn = get_connection()
+    result = conn.execute('''
+    SELECT content_sha, job_id, completed_at
+    FROM script_runs
+    WHERE script_name = ? AND subject = ? AND arguments_hash = ?
+    ''', (script_name, subject, arguments_hash)).fetchone()
+    return dict(result) if result else None
 
 
 # --- Token management ---
 
 def save_token(token, created_at, expires_at):
-    conn = sqlite3.connect(JOB_DB_PATH)
-    c = conn.cursor()
-    c.execute('''
-    DELETE FROM app_token
-    ''')
-    c.execute('''
-    INSERT INTO app_token (token, created_at, expires_at)
-    VALUES (?, ?, ?)
-    ''', (token, created_at, expires_at))
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        conn.execute('''
+        DELETE FROM app_token
+        ''')
+        conn.execute('''
+        INSERT INTO app_token (token, created_at, expires_at)
+        VALUES (?, ?, ?)
+        ''', (token, created_at, expires_at))
 
 
 def get_token():
-    conn = sqlite3.connect(JOB_DB_PATH)
-    c = conn.cursor()
-    c.execute('''
+    conn = get_connection()
+    result = conn.execute('''
     SELECT token, created_at, expires_at
     FROM app_token
-    ''')
-    result = c.fetchone()
-    conn.close()
+    ''').fetchone()
     return result
@@ -0,0 +1,223 @@
+"""
+Versioned schema migrations for the job queue database.
+
+The schema version of a database file is kept in SQLite's `user_version` pragma. Each function in MIGRATIONS upgrades
+the schema by one version; migrate() applies whichever ones a database hasn't had yet, so existing job_queue.db files
+are upgraded in place on startup. New migrations must only ever be appended to the list.
+"""
+from constants import *
+from db_connection import get_connection, transaction
+
+
+def add_column_if_missing(conn, table, column, definition):
+    columns = [row["name"] for row in conn.execute(f"PRAGMA table_xinfo({table})")]
+    if column not in columns:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+# Version 1: the original job queue and token tables
+def _create_initial_tables(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS job_queue (
+        id TEXT PRIMARY KEY,
+        job_type TEXT NOT NULL,
+        job_data JSON DEFAULT NULL,
+        status TEXT NOT NULL,
+        enqueued_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        executed_at DATETIME DEFAULT NULL,
+        run_duration DATETIME DEFAULT NULL,
+        wait_duration DATETIME DEFAULT NULL
+    )
+    ''')
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS app_token (
+        token TEXT PRIMARY KEY,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        expires_at DATETIME DEFAULT NULL
+    )
+    ''')
+
+
+# Version 2: job leases (see get_next_job). Databases created by the pre-versioning init_db may already have these.
+def _add_job_leases(conn):
+    add_column_if_missing(conn, "job_queue", "claimed_by", "TEXT DEFAULT NULL")
+    add_column_if_missing(conn, "job_queue", "lease_expires_at", "DATETIME DEFAULT NULL")
+
+
+# Version 3: promote the job_data fields we filter on to (generated) columns, and index the hot lookups
+def _add_job_data_columns_and_indexes(conn):
+    add_column_if_missing(conn, "job_queue", "issue_number",
+                          "INTEGER GENERATED ALWAYS AS (json_extract(job_data, '$.issue_number')) VIRTUAL")
+    add_column_if_missing(conn, "job_queue", "script_name",
+                          "TEXT GENERATED ALWAYS AS (json_extract(job_data, '$.script_name')) VIRTUAL")
+    add_column_if_missing(conn, "job_queue", "subject",
+                          "TEXT GENERATED ALWAYS AS (json_extract(job_data, '$.subject')) VIRTUAL")
+    conn.execute("CREATE INDEX IF NOT EXISTS job_queue_status_enqueued_at ON job_queue (status, enqueued_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS job_queue_type_issue_status ON job_queue (job_type, issue_number, status)")
+
+
+# Version 4: move script output (`result`) and error text (`error`) out of job_data into their own table, leaving just
+# their sizes in the job row
+def _add_job_output_table(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS job_output (
+        job_id TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        body TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (job_id, kind)
+    )
+    ''')
+    for kind in JOB_OUTPUT_KINDS:
+        conn.execute(f'''
+        INSERT OR REPLACE INTO job_output (job_id, kind, body, size)
+        SELECT id, '{kind}', json_extract(job_data, '$.{kind}'), LENGTH(json_extract(job_data, '$.{kind}'))
+        FROM job_queue
+        WHERE json_type(job_data, '$.{kind}') = 'text'
+        ''')
+        conn.execute(f'''
+        UPDATE job_queue
+        SET job_data = json_set(json_remove(job_data, '$.{kind}'), '$.{kind}_size', LENGTH(json_extract(job_data, '$.{kind}')))
+        WHERE json_type(job_data, '$.{kind}') = 'text'
+        ''')
+        # Anything else (e.g. a null result) carries no output, so just drop it
+        conn.execute(f'''
+        UPDATE job_queue
+        SET job_data = json_remove(job_data, '$.{kind}')
+        WHERE json_type(job_data, '$.{kind}') IS NOT NULL
+        ''')
+
+
+# Version 5: when each repo checkout was last synced with its remote, and the commit it was synced to
+def _add_repo_sync_state_table(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS repo_sync_state (
+        repo_path TEXT PRIMARY KEY,
+        sha TEXT NOT NULL,
+        synced_at REAL NOT NULL
+    )
+    ''')
+
+
+# Version 6: output files that have been uploaded to GitHub, by the SHA-256 of their contents, so an identical file from a
+# later job can link to the earlier upload rather than being uploaded again
+def _add_output_artifacts_table(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS output_artifacts (
+        content_hash TEXT PRIMARY KEY,
+        url TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        uploaded_size INTEGER NOT NULL,
+        created_at REAL NOT NULL
+    )
+    ''')
+
+
+# Version 7: saved results of read scripts (see result_cache.py), with when each was last used so the least recently used
+# can be evicted
+def _add_result_cache_table(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS result_cache (
+        cache_key TEXT PRIMARY KEY,
+        job_id TEXT NOT NULL,
+        script_name TEXT NOT NULL,
+        subject TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        created_at REAL NOT NULL,
+        last_used_at REAL NOT NULL
+    )
+    ''')
+    conn.execute('''
+    CREATE INDEX IF NOT EXISTS result_cache_last_used_at ON result_cache (last_used_at)
+    ''')
+
+
+# Version 8: the content commit each incremental script (see incremental_runs.py) last ran successfully against
+def _add_script_runs_table(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS script_runs (
+        script_name TEXT NOT NULL,
+        subject TEXT NOT NULL,
+        arguments_hash TEXT NOT NULL,
+        content_sha TEXT NOT NULL,
+        job_id TEXT NOT NULL,
+        completed_at REAL NOT NULL,
+        PRIMARY KEY (script_name, subject, arguments_hash)
+    )
+    ''')
+
+
+# Version 9: why a job was stopped early - cancelled, or its script ran over one of its limits
+def _add_job_stop_reason(conn):
+    add_column_if_missing(conn, "job_queue", "stop_reason", "TEXT DEFAULT NULL")
+
+
+MIGRATIONS = [
+    _create_initial_tables,
+    _add_job_leases,
+    _add_job_data_columns_and_indexes,
+    _add_job_output_table,
+    _add_repo_sync_state_table,
+    _add_output_artifacts_table,
+    _add_result_cache_table,
+    _add_script_runs_table,
+    _add_job_stop_reason,
+]
+
+
+def get_schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(logger=lambda x: None):
+    with transaction() as conn:
+        version = get_schema_version(conn)
+        if version > len(MIGRATIONS):
+            raise Exception(f"Database schema version {version} is newer than this code supports ({len(MIGRATIONS)})")
+        # All pending migrations run in one transaction, so a failure leaves the database at its previous version
+        # rather than half-upgraded
+        for new_version in range(version + 1, len(MIGRATIONS) + 1):
+            logger(f"Migrating job queue database to schema version {new_version}...")
+            MIGRATIONS[new_version - 1](conn)
+            conn.execute(f"PRAGMA user_version = {new_version}")
+
+
+# auto_vacuum can only be switched on for an existing database by rebuilding it with VACUUM, which can't run inside a
+# transaction, so this is done separately from the versioned migrations (it is a no-op once enabled)
+def enable_incremental_vacuum(logger=lambda x: None):
+    conn = get_connection()
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != DB_AUTO_VACUUM_INCREMENTAL:
+        logger("Enabling incremental auto-vacuum on the job queue database (rebuilding it with VACUUM)...")
+        conn.execute(f"PRAGMA auto_vacuum = {DB_AUTO_VACUUM_INCREMENTAL}")
+        conn.execute("VACUUM")
+
+
+# The archive database holds finished and failed jobs moved out of the live job_queue table (see archive_old_jobs).
+# Its output bodies are zlib-compressed.
+def create_archive_tables(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS job_queue_archive (
+        id TEXT PRIMARY KEY,
+        job_type TEXT NOT NULL,
+        job_data JSON DEFAULT NULL,
+        status TEXT NOT NULL,
+        enqueued_at DATETIME,
+        executed_at DATETIME,
+        run_duration DATETIME,
+        wait_duration DATETIME,
+        archived_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        stop_reason TEXT DEFAULT NULL
+    )
+    ''')
+    # Archives created before jobs had stop reasons
+    add_column_if_missing(conn, "job_queue_archive", "stop_reason", "TEXT DEFAULT NULL")
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS job_output_archive (
+        job_id TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        body BLOB NOT NULL,
+        size INTEGER NOT NULL,
+        PRIMARY KEY (job_id, kind)
+    )
+    ''')
@@ -0,0 +1,106 @@
+"""
+Authentication with GitHub as the script dispatcher's GitHub App installation.
+
+Installation tokens last an hour. The job runner keeps the current one in memory (and in the database, so a restarted
+runner can pick it up again), and a background thread replaces it GITHUB_TOKEN_REFRESH_MARGIN seconds before it
+expires, so jobs asking for a token almost never have to wait for one to be minted.
+
+The token is also put in the runner's environment as GIT_TOKEN_ENV_VAR, where the credential helper configured in each
+repo (see configure_repo_credentials in git_logic.py) finds it. git subprocesses inherit the environment, so a new
+token takes effect without touching the repos' configuration. Scripts are started without it (see get_script_base_env in
+script_process.py).
+"""
+import os
+import threading
+import time
+
+import dateutil.parser
+import jwt
+
+from constants import *
+from db_logic import get_token, save_token
+from github_client import github_client
+
+
+def generate_jwt(app_id, private_key):
+    payload = {
+        "iat": int(time.time()),
+        "exp": int(time.time()) + 60,
+        "iss": app_id,
+    }
+    token = jwt.encode(payload, private_key, algorithm="RS256")
+    return token
+
+
+def get_installation_token(json_web_token, installation_id):
+    response = github_client.post(
+        "/app/installations/{installation_id}/access_tokens",
+        path_params={"installation_id": installation_id},
+        headers={"Authorization": f"Bearer {json_web_token}"},
+        # A token made by a request that seemed to fail just goes unused
+        retry_server_errors=True,
+    )
+
+    if response.status_code == 201:
+        return response.json()
+    else:
+        raise Exception(f"Failed to get installation token. Status code: {response.status_code}, Response: {response.text}")
+
+
+class GitHubTokenManager:
+    def __init__(self):
+        # Held while the token is being replaced, so concurrent callers wait for one new token rather than each minting
+        # their own
+        self._lock = threading.Lock()
+        self._token = None
+        self._expires_at = 0
+        self._loaded = False
+
+    # Return a token with at least `min_validity` seconds left to run, replacing the current one if needed
+    def get_token(self, logger=lambda x: None, min_validity=GITHUB_TOKEN_MIN_VALIDITY):
+        with self._lock:
+            if not self._loaded:
+                # Pick up the token saved by a previous runner, if it is still good
+                self._loaded = True
+                if (db_token := get_token()) is not None:
+                    self._set_token(db_token[0], float(db_token[2]))
+            if self._expires_at < time.time() + min_validity:
+                self._refresh(logger)
+            return self._token
+
+    def _set_token(self, token, expires_at):
+        self._token = token
+        self._expires_at = expires_at
+        os.environ[GIT_TOKEN_ENV_VAR] = token
+
+    def _refresh(self, logger):
+        logger("Getting new GitHub installation token")
+        with open(KEY_PATH, "r") as f:
+            private_key = f.read()
+        json_web_token = generate_jwt(os.getenv("GITHUB_APP_IDENTIFIER"), private_key)
+        token = get_installation_token(json_web_token, os.getenv("GITHUB_INSTALLATION_ID"))
+        expires_at = dateutil.parser.isoparse(token["expires_at"]).timestamp()
+        save_token(token["token"], time.time(), expires_at)
+        self._set_token(token["token"], expires_at)
+        logger(f"Got new GitHub installation token, expiring at {token['expires_at']}")
+
+    # Replace the token GITHUB_TOKEN_REFRESH_MARGIN seconds before it expires, forever
+    def run(self, logger=lambda x: None):
+        while True:
+            try:
+                self.get_token(logger=logger, min_validity=GITHUB_TOKEN_REFRESH_MARGIN)
+            except Exception as e:
+                logger(f"Error refreshing GitHub installation token: {e}")
+                time.sleep(GITHUB_TOKEN_RETRY_INTERVAL)
+                continue
+            time.sleep(max(self._expires_at - GITHUB_TOKEN_REFRESH_MARGIN - time.time(), 1))
+
+    def start(self, logger=lambda x: None):
+        threading.Thread(target=self.run, kwargs={"logger": logger}, daemon=True, name="github-token-refresher").start()
+
+
+github_token_manager = GitHubTokenManager()
+
+
+def get_github_token(logger=lambda x: None):
+    return github_token_manager.get_token(logger=logger)
@@ -0,0 +1,150 @@
+"""
+A shared client for the GitHub REST API.
+
+All calls to the API go through one requests.Session, so connections (and their TLS sessions) to api.github.com are
+kept alive and reused rather than set up from scratch for every call. Requests that are turned away by a rate limit
+are retried with a backoff - honouring Retry-After and X-RateLimit-Reset where GitHub sends them - and once the primary
+rate limit is used up, further requests wait for it to reset rather than failing. Requests that fail with a server
+error or a dropped connection may still have been carried out, so are only retried if they are safe to repeat (e.g. a
+GET, or creating a blob), and not if repeating them would e.g. post a comment twice.
+
+The client also keeps a count of the requests made to each endpoint, and how long they took, for get_stats().
+"""
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from constants import *
+
+
+class GitHubClient:
+    def __init__(self, base_url=GITHUB_API_URL, max_retries=GITHUB_MAX_RETRIES, pool_size=GITHUB_POOL_SIZE):
+        self.base_url = base_url
+        self.max_retries = max_retries
+        self.session = requests.Session()
+        self.session.headers.update({
+            "Accept": "application/vnd.github+json",
+            "X-GitHub-Api-Version": GITHUB_API_VERSION,
+        })
+        # Several job executors may be talking to GitHub at once, so keep enough connections open for all of them
+        self.session.mount("https://", HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
+        self._lock = threading.Lock()
+        # The time at which the primary rate limit resets, if it has been used up
+        self._rate_limited_until = 0
+        # "METHOD /endpoint/{template}" -> counters, see get_stats
+        self._stats = {}
+
+    # Make a request to `endpoint`, a path template such as "/repos/{repo}/issues/{issue_number}/comments" which is
+    # filled in from `path_params`. The template (rather than the full path) is what latency is recorded against, so
+    # that calls to the same endpoint for different issues are counted together. If `token` is given it is used to
+    # authenticate, otherwise the caller should pass an Authorization header. `retry_server_errors` says whether the
+    # request is safe to retry after a server error or dropped connection, and defaults to whether `method` is
+    # idempotent. Returns the final response, whether or not it was successful - it is up to the caller to check the
+    # status code.
+    def request(self, method, endpoint, path_params=None, token=None, headers=None, retry_server_errors=None, **kwargs):
+        if retry_server_errors is None:
+            retry_server_errors = method in GITHUB_IDEMPOTENT_METHODS
+        url = self.base_url + endpoint.format(**(path_params or {}))
+        headers = dict(headers or {})
+        if token is not None:
+            headers["Authorization"] = f"token {token}"
+        kwargs.setdefault("timeout", GITHUB_REQUEST_TIMEOUT)
+
+        attempt = 0
+        while True:
+            self._wait_for_rate_limit()
+            start = time.perf_counter()
+            try:
+                response = self.session.request(method, url, headers=headers, **kwargs)
+            except requests.ConnectionError:
+                retry = retry_server_errors and attempt < self.max_retries
+                self._record(method, endpoint, time.perf_counter() - start, error=True, retry=retry)
+                if not retry:
+                    raise
+                time.sleep(self._backoff(attempt))
+                attempt += 1
+                continue
+
+            self._update_rate_limit(response)
+            retry_wait = self._get_retry_wait(response, attempt, retry_server_errors)
+            retry = retry_wait is not None and attempt < self.max_retries
+            self._record(method, endpoint, time.perf_counter() - start, error=not response.ok, retry=retry)
+            if not retry:
+                return response
+            time.sleep(retry_wait)
+            attempt += 1
+
+    def get(self, endpoint, **kwargs):
+        return self.request("GET", endpoint, **kwargs)
+
+    def post(self, endpoint, **kwargs):
+        return self.request("POST", endpoint, **kwargs)
+
+    def put(self, endpoint, **kwargs):
+        return self.request("PUT", endpoint, **kwargs)
+
+    def patch(self, endpoint, **kwargs):
+        return self.request("PATCH", endpoint, **kwargs)
+
+    @staticmethod
+    def _backoff(attempt):
+        return min(GITHUB_RETRY_BACKOFF * 2 ** attempt, GITHUB_MAX_RETRY_WAIT)
+
+    # How long to wait before retrying the request that got `response`, or None if it shouldn't be retried
+    def _get_retry_wait(self, response, attempt, retry_server_errors=True):
+        if response.status_code in GITHUB_RETRY_STATUS_CODES:
+            return self._backoff(attempt) if retry_server_errors else None
+        if response.status_code in (403, 429):
+            # Secondary rate limits come with a Retry-After header; primary ones with X-RateLimit-Remaining of 0.
+            # Any other 403 is a real permissions error, and retrying won't help.
+            retry_after = response.headers.get("Retry-After")
+            if retry_after is not None:
+                return min(float(retry_after), GITHUB_MAX_RETRY_WAIT)
+            if response.headers.get("X-RateLimit-Remaining") == "0":
+                reset = float(response.headers.get("X-RateLimit-Reset", 0))
+                return min(max(reset - time.time(), self._backoff(attempt)), GITHUB_MAX_RETRY_WAIT)
+        return None
+
+    def _update_rate_limit(self, response):
+        if response.headers.get("X-RateLimit-Remaining") == "0" and "X-RateLimit-Reset" in response.headers:
+            with self._lock:
+                self._rate_limited_until = float(response.headers["X-RateLimit-Reset"])
+
+    # If a previous response used up the rate limit, hold off until it resets rather than sending requests that are
+    # bound to be refused
+    def _wait_for_rate_limit(self):
+        with self._lock:
+            wait = self._rate_limited_until - time.time()
+        if wait > 0:
+            time.sleep(min(wait, GITHUB_MAX_RETRY_WAIT))
+
+    def _record(self, method, endpoint, elapsed, error=False, retry=False):
+        with self._lock:
+            stats = self._stats.setdefault(f"{method} {endpoint}", {
+                "count": 0, "errors": 0, "retries": 0, "total_time": 0.0, "max_time": 0.0
+            })
+            stats["count"] += 1
+            stats["errors"] += error
+            stats["retries"] += retry
+            stats["total_time"] += elapsed
+            stats["max_time"] = max(stats["max_time"], elapsed)
+
+    # Per-endpoint request counts and latencies (in seconds) since the client was created
+    def get_stats(self):
+        with self._lock:
+            return {
+                endpoint: {**stats, "mean_time": stats["total_time"] / stats["count"]}
+                for endpoint, stats in self._stats.items()
+            }
+
+    def format_stats(self):
+        return "; ".join(
+            f"{endpoint}: {stats['count']} requests ({stats['errors']} failed, {stats['retries']} retried), "
+            f"mean {stats['mean_time'] * 1000:.0f}ms, max {stats['max_time'] * 1000:.0f}ms"
+            for endpoint, stats in sorted(self.get_stats().items())
+        )
+
+
+github_client = GitHubClient()
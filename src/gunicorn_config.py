@@ -8,7 +8,7 @@ workers = 4  # Not including the job runner process
 def on_starting(server):
     # Initialize the database before starting the server
     print("[STARTUP] Initialising job queue database...")
-    init_db()
+    init_db(logger=lambda message: print(f"[STARTUP] {message}"))
     print("[STARTUP] Job queue database initialised.")
     print("[STARTUP] Starting job queue processing thread...")
     init_worker_process()
@@ -0,0 +1,79 @@
+"""
+Incremental runs of scripts over the content repo.
+
+Scripts such as link_checker walk the whole content repo every time they run, even though usually only a handful of
+files have changed since the last run. Scripts marked "incremental" in SCRIPTS are told what has changed since they last
+ran successfully for the subject (with the same arguments), so they can process just those files and merge the results
+into their previous output. The script is given, as environment variables:
+
+- PREVIOUS_SHA_ENV_VAR and CURRENT_SHA_ENV_VAR: the content commit of the last successful run, and of this one
+- CHANGES_PATH_ENV_VAR: the path of a JSON file listing the files changed between the two, as
+  {"previous_sha", "current_sha", "changes": [{"status", "path"}]} (see get_changed_paths in git_logic.py)
+- PREVIOUS_OUTPUT_PATH_ENV_VAR: the output directory of the last successful run, if it is still there (when a job is
+  rerun, its previous output is moved out of its output directory first - see set_aside_previous_output)
+
+None of these are set if the script has never run successfully, or if the previous commit isn't available (e.g. in a
+shallow clone) - the script must then process the whole repo as usual.
+"""
+import json
+import os
+import shutil
+
+from constants import *
+from db_logic import get_last_script_run, save_script_run
+from git_logic import commit_exists, get_changed_paths, get_commit_sha
+
+
+# The environment variables to give an incremental run of `script_name` (see above)
+def get_incremental_run_env(script_name, subject, arguments_hash, content_path, job_id, logger=lambda x: None):
+    last_run = get_last_script_run(script_name, subject, arguments_hash)
+    if last_run is None:
+        logger(f"No previous run of {script_name} for {subject} with these arguments, running over the whole repo")
+        return {}
+    previous_sha = last_run["content_sha"]
+    if not commit_exists(content_path, previous_sha):
+        logger(f"Commit {previous_sha[:7]} of the previous run of {script_name} isn't available, running over the whole repo")
+        return {}
+
+    current_sha = get_commit_sha(content_path, "HEAD")
+    changes = get_changed_paths(content_path, previous_sha, current_sha)
+    logger(f"{len(changes)} files changed since the previous run of {script_name} ({previous_sha[:7]} -> {current_sha[:7]})")
+    # The job's input directory is removed once it has finished, so the manifest is cleaned up with it
+    os.makedirs(f"{INPUT_PATH}/{job_id}", exist_ok=True)
+    changes_path = f"{INPUT_PATH}/{job_id}/changes.json"
+    with open(changes_path, "w") as f:
+        json.dump({"previous_sha": previous_sha, "current_sha": current_sha, "changes": changes}, f)
+
+    env = {
+        PREVIOUS_SHA_ENV_VAR: previous_sha,
+        CURRENT_SHA_ENV_VAR: current_sha,
+        CHANGES_PATH_ENV_VAR: os.path.abspath(changes_path),
+    }
+    # A rerun of the same job writes to the same output directory, so its last output has been moved elsewhere
+    previous_output_path = get_previous_output_path(job_id) if last_run["job_id"] == job_id else f"{OUTPUT_PATH}/{last_run['job_id']}"
+    if os.path.isdir(previous_output_path):
+        env[PREVIOUS_OUTPUT_PATH_ENV_VAR] = os.path.abspath(previous_output_path)
+    return env
+
+
+# Record that job `job_id` ran `script_name` over content commit `content_sha`. Only called once the job has finished,
+# so that a run whose results never made it to the issue isn't used as the starting point for the next one.
+def record_successful_run(script_name, subject, arguments_hash, content_sha, job_id):
+    save_script_run(script_name, subject, arguments_hash, content_sha, job_id)
+
+
+# Where the output of a job's previous run is kept while it is rerun. It is in the job's input directory, so is removed
+# along with it once the job has finished.
+def get_previous_output_path(job_id):
+    return f"{INPUT_PATH}/{job_id}/previous_output"
+
+
+# Move the output left in `output_dir` by a previous run of job `job_id` (if it is being rerun) out of the way, so the
+# new run starts with an empty output directory and can still read the old output
+def set_aside_previous_output(job_id, output_dir):
+    if not os.path.exists(output_dir):
+        return
+    previous_output_path = get_previous_output_path(job_id)
+    shutil.rmtree(previous_output_path, ignore_errors=True)
+    os.makedirs(os.path.dirname(previous_output_path), exist_ok=True)
+    shutil.move(output_dir, previous_output_path)
@@ -0,0 +1,57 @@
+"""
+Per-job log files of scripts' output.
+
+A script's stdout and stderr go straight to files under JOB_LOG_PATH/<job_id>/ as it runs, so the runner never holds a
+script's whole output in memory, and the output so far can be read (through /status/<job_id>/log) while the script is
+still running.
+"""
+import os
+import shutil
+import time
+
+from constants import *
+
+
+def get_job_log_dir(job_id):
+    return f"{JOB_LOG_PATH}/{job_id}"
+
+
+def get_job_log_path(job_id, stream):
+    return f"{get_job_log_dir(job_id)}/{stream}.log"
+
+
+# Read up to `limit` bytes of a job's log, from byte `offset`. Returns None if there is no such log, otherwise the data
+# (which, as the log may be being written as we read it, may stop part way through a line), the offset to read on from,
+# and the log's size.
+def read_job_log(job_id, stream, offset=0, limit=JOB_LOG_READ_DEFAULT_LIMIT):
+    try:
+        with open(get_job_log_path(job_id, stream), "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            f.seek(offset)
+            data = f.read(limit)
+    except FileNotFoundError:
+        return None
+    return {"data": data.decode("utf-8", errors="replace"), "next_offset": offset + len(data), "size": size}
+
+
+# The last `size` bytes of the file at `path`, and whether anything before them was left out
+def read_tail(path, size):
+    with open(path, "rb") as f:
+        file_size = os.fstat(f.fileno()).st_size
+        f.seek(max(0, file_size - size))
+        data = f.read()
+    return data.decode("utf-8", errors="replace"), file_size > size
+
+
+# Delete the logs of jobs that finished more than `max_age` seconds ago
+def remove_old_job_logs(max_age, logger=lambda x: None):
+    if not os.path.exists(JOB_LOG_PATH):
+        return 0
+    removed = 0
+    for entry in os.scandir(JOB_LOG_PATH):
+        if entry.is_dir() and entry.stat().st_mtime < time.time() - max_age:
+            shutil.rmtree(entry.path, ignore_errors=True)
+            removed += 1
+    if removed:
+        logger(f"Removed the logs of {removed} old jobs")
+    return removed
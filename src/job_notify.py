@@ -0,0 +1,52 @@
+"""
+Local notification channel from the web workers to the job runner.
+
+The job runner listens on a Unix domain datagram socket, and the web workers send it a small datagram whenever they
+queue up work, so jobs start straight away rather than on the runner's next poll. Notifications are best effort: if
+the runner isn't listening (or is too busy to drain its socket) nothing is lost, because it still polls the queue
+every JOB_FALLBACK_POLL_INTERVAL seconds.
+"""
+import os
+import select
+import socket
+
+from constants import *
+
+
+def notify_job_runner(message=JOB_NOTIFY_NEW_JOB):
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.setblocking(False)
+            sock.sendto(message.encode("utf-8"), JOB_NOTIFY_SOCKET_PATH)
+    except OSError:
+        # The runner isn't listening yet, or its queue of notifications is full - either way it will poll soon
+        pass
+
+
+class JobNotificationListener:
+    def __init__(self, path=JOB_NOTIFY_SOCKET_PATH):
+        self.path = path
+        # Remove the socket left behind by a previous runner, if any
+        if os.path.exists(path):
+            os.unlink(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(path)
+        self.sock.setblocking(False)
+
+    # Wait up to `timeout` seconds for notifications, returning all that have arrived (an empty list on timeout).
+    # Notifications sent while we weren't waiting are queued by the socket, so none are missed between polls.
+    def wait(self, timeout):
+        readable, _, _ = select.select([self.sock], [], [], timeout)
+        messages = []
+        if readable:
+            while True:
+                try:
+                    messages.append(self.sock.recv(JOB_NOTIFY_MAX_MESSAGE_SIZE).decode("utf-8"))
+                except BlockingIOError:
+                    break
+        return messages
+
+    def close(self):
+        self.sock.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
@@ -1,54 +1,218 @@
+import logging
 import os
+import queue
 import shutil
 import signal
+import socket
 import subprocess
+import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener
 from multiprocessing import Process
 
-import requests
-
-from db_logic import get_next_job, update_job_status
+from db_logic import get_next_job, update_job_status, renew_job_lease, archive_old_jobs, reclaim_free_pages, get_job_stop_reason, \
+    set_job_stop_reason
 from constants import *
-from git_logic import new_branch_and_push_changes, pull_repos, get_github_token, add_reaction_to_issue, \
-    add_comment_to_issue, upload_file_to_github, create_pull_request, download_and_save_file, clone_if_needed
-from script_manager import SCRIPTS, GOOGLE_DOC_PUBLISH_HOW_TO
+from content_index import get_content_index
+from git_logic import commit_and_push_changes, discard_changes, new_branch_and_push_changes, get_commit_sha, job_worktree, prune_worktrees, pull_repos, configure_repo_credentials, add_reaction_to_issue, \
+    add_comment_to_issue, create_pull_request, download_and_save_file, upload_files_to_github
+from github_auth import get_github_token, github_token_manager
+from github_client import github_client
+from incremental_runs import get_incremental_run_env, record_successful_run, set_aside_previous_output
+from job_logs import get_job_log_dir, get_job_log_path, read_tail, remove_old_job_logs
+from job_notify import JobNotificationListener
+from output_artifacts import upload_job_outputs
+from repo_locks import read_lock, write_lock
+from repo_sync import repo_syncer
+from result_cache import get_cache_key, hash_arguments, load_cached_result, save_cached_result
+from script_manager import SCRIPTS, GOOGLE_DOC_PUBLISH_HOW_TO, get_script_limits, script_uses_content_index
+from script_process import get_script_base_env, start_script, script_forkserver
+
+
+runner_logger = logging.getLogger("job_runner")
 
 
 def logger(message):
-    # Post log message to localhost:5000/log
-    requests.post("http://localhost:5000/log", json={"message": f"[WORKER] {message}"})
+    runner_logger.info(message)
+
+
+# The runner logs straight to stderr (alongside gunicorn's own logs), but through a queue: logging only puts the record
+# on the queue, and a listener thread writes records out, so a job never waits on a slow log stream
+def start_logging():
+    log_queue = queue.SimpleQueue()
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter("[%(asctime)s] [%(process)d] [WORKER] [%(threadName)s] %(message)s",
+                                           "%Y-%m-%d %H:%M:%S %z"))
+    listener = QueueListener(log_queue, handler)
+    runner_logger.addHandler(QueueHandler(log_queue))
+    runner_logger.setLevel(logging.INFO)
+    runner_logger.propagate = False
+    listener.start()
+    return listener
+
+
+# This runner's id, which the jobs it claims are leased to
+def get_worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+# Set the status of a job this runner has claimed, if it still holds it: if the job's lease was lost, another runner may
+# have claimed the job since, and its status is that runner's to set (see keep_job_leased)
+def update_claimed_job_status(job_id, new_status, data=None, logger=lambda x: None):
+    if not update_job_status(job_id, new_status, data, logger=logger, worker_id=get_worker_id()):
+        logger(f"Job ID {job_id}: not setting its status to {new_status}, as it is no longer claimed by this runner.")
+
 
+# Whether the lease on job `job_id` has been lost, in which case the job is left alone rather than going on to `step`
+def lease_lost_before(job_id, step):
+    if job_lease_lost(job_id):
+        logger(f"Job ID {job_id}: lease lost, not {step}.")
+        return True
+    return False
 
-# Comment on the GitHub issue, failing the job and returning False if the comment fails to post
+
+# Comment on the GitHub issue, failing the job and returning False if the comment fails to post. Nothing is posted if
+# the job's lease has been lost.
 def comment(token, job_id, issue_number, message):
+    if lease_lost_before(job_id, "commenting on its issue"):
+        return False
     logger(f"Commenting on issue {issue_number} with message: {message[:100]}" + ("..." if len(message) > 100 else ""))
     response = add_comment_to_issue(token, issue_number, message)
     if not response.status_code == 201:
-        update_job_status(job_id, JobRunStatus.FAILED, {"error": f"Failed to add comment: {response.text}"}, logger=logger)
+        update_claimed_job_status(job_id, JobRunStatus.FAILED, {"error": f"Failed to add comment: {response.text}"}, logger=logger)
         return False
     return True
 
 
-def run_python_script(script_name, job_id, subject, args):
-    if not os.path.exists(f"{SCRIPT_DISPATCHER_SCRIPTS_SUBDIR}/{script_name}_script.py"):
+# The script is told where the checkout of the content repo it should work on is through the environment, as write
+# scripts that opt in get their own worktree rather than using the shared checkout
+def run_python_script(script_name, job_id, subject, args, content_path, extra_env=None):
+    script_path = f"{SCRIPTS_PATH}/{SCRIPT_DISPATCHER_SUBDIR_NAME}/{script_name}_script.py"
+    if not os.path.exists(script_path):
         return {"error": f"Script `{script_name}` does not exist"}
-
+    if job_lease_lost(job_id):
+        return {"error": JOB_LEASE_LOST_REASON, "stop_reason": JOB_LEASE_LOST_REASON}
+    if stop_reason := get_job_stop_reason(job_id):
+        return {"error": f"Cancelled: {stop_reason}", "stop_reason": stop_reason}
+
+    limits = get_script_limits(script_name)
+    env = {**get_script_base_env(), CONTENT_PATH_ENV_VAR: os.path.abspath(content_path)}
+    # Scripts that opt in can look the content up in the index of its commit rather than walking the repo (see
+    # content_index.py)
+    if script_uses_content_index(script_name):
+        try:
+            env[CONTENT_INDEX_PATH_ENV_VAR] = os.path.abspath(get_content_index(subject, content_path, logger=logger))
+        except Exception as e:
+            logger(f"Failed to build the content index for job {job_id}, running the script without it: {e}")
+    # The script's output goes straight to its log files (see job_logs.py), and only the end of it is kept in memory
+    os.makedirs(get_job_log_dir(job_id), exist_ok=True)
+    stdout_path, stderr_path = get_job_log_path(job_id, "stdout"), get_job_log_path(job_id, "stderr")
     try:
-        result = subprocess.run(
-            [
-                "python", f"{SCRIPT_DISPATCHER_SCRIPTS_SUBDIR}/{script_name}_script.py", "-j", job_id, "--subject", subject, *args
-            ],
-            capture_output=True,
-            check=True,
-            text=True,
-        )
-        return {"result": result.stdout}
-    except subprocess.CalledProcessError as e:
-        return {"error": e.stderr}
+        with open(stdout_path, "wb") as stdout, open(stderr_path, "wb") as stderr:
+            # Scripts are forked from a warm interpreter unless they opt out (see script_process.py)
+            process = start_script(
+                script_path,
+                ["-j", job_id, "--subject", subject, *args],
+                stdout,
+                stderr,
+                {**env, **(extra_env or {})},
+                limits,
+                warm=SCRIPTS[script_name].get("warm", True),
+                logger=logger,
+            )
+            stop_reason = wait_for_script(process, job_id, limits)
+        # Python ignores SIGXFSZ, so a script that goes over its output limit fails with "File too large" rather than
+        # being killed - tell that apart by the size of its logs
+        if stop_reason is None and process.returncode != 0 and \
+                max(os.path.getsize(stdout_path), os.path.getsize(stderr_path)) >= limits["max_output"]:
+            stop_reason = f"Stopped after writing more than {limits['max_output']} bytes of output"
+            set_job_stop_reason(job_id, stop_reason, worker_id=get_worker_id())
+        if stop_reason:
+            return {"error": f"{stop_reason}\n\n{read_tail(stderr_path, JOB_LOG_TAIL_SIZE)[0]}", "stop_reason": stop_reason}
+        if process.returncode != 0:
+            return {"error": read_tail(stderr_path, JOB_LOG_TAIL_SIZE)[0]}
+        return {"result": read_tail(stdout_path, JOB_LOG_TAIL_SIZE)[0]}
     except Exception as e:
         return {"error": str(e)}
 
 
+# Events to stop the scripts running now, by job id, set when their jobs are cancelled or their leases are lost
+script_stop_events = {}
+script_stop_events_lock = threading.Lock()
+# Jobs whose lease this runner has lost (see keep_job_leased). Another runner may have claimed them since, so their
+# scripts are stopped and nothing more is recorded for them here.
+lost_job_leases = set()
+JOB_LEASE_LOST_REASON = "The lease on the job was lost"
+
+
+def job_lease_lost(job_id):
+    with script_stop_events_lock:
+        return job_id in lost_job_leases
+
+
+def stop_running_script(job_id):
+    with script_stop_events_lock:
+        if job_id in script_stop_events:
+            script_stop_events[job_id].set()
+
+
+def kill_process_group(process):
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+# Wait for the script `process` of job `job_id` to finish, killing it if it runs for longer than its timeout, the job
+# is cancelled or its lease is lost. The CPU time, memory and output limits are enforced by the kernel (see set_script_limits in
+# script_process.py). Returns why the script was stopped, or None if it finished by itself.
+def wait_for_script(process, job_id, limits):
+    stop_event = threading.Event()
+    with script_stop_events_lock:
+        script_stop_events[job_id] = stop_event
+    try:
+        start = last_stop_check = time.monotonic()
+        stop_reason = None
+        while stop_reason is None:
+            try:
+                process.wait(timeout=SCRIPT_POLL_INTERVAL)
+                break
+            except subprocess.TimeoutExpired:
+                pass
+            if time.monotonic() - start > limits["timeout"]:
+                stop_reason = f"Stopped after running for longer than {limits['timeout']}s"
+            elif stop_event.is_set() or time.monotonic() - last_stop_check > JOB_STOP_CHECK_INTERVAL:
+                # Cancellations are recorded in the job, and we are notified of them - but check the job every so
+                # often anyway, in case the notification was missed
+                last_stop_check = time.monotonic()
+                if job_lease_lost(job_id):
+                    stop_reason = JOB_LEASE_LOST_REASON
+                elif cancel_reason := get_job_stop_reason(job_id):
+                    stop_reason = f"Cancelled: {cancel_reason}"
+    finally:
+        with script_stop_events_lock:
+            del script_stop_events[job_id]
+        # Kill anything the script left running too, whether or not it finished
+        kill_process_group(process)
+        process.wait()
+
+    if stop_reason is None and process.returncode == -signal.SIGXCPU:
+        stop_reason = f"Stopped after using more than {limits['cpu_time']}s of CPU time"
+    if stop_reason and not stop_reason.startswith("Cancelled") and stop_reason != JOB_LEASE_LOST_REASON:
+        set_job_stop_reason(job_id, stop_reason, worker_id=get_worker_id())
+    return stop_reason
+
+
+# Shorten script output to fit in an issue comment, keeping the end of it (where the summary or error usually is)
+def truncate_for_comment(output):
+    if len(output) <= ISSUE_COMMENT_OUTPUT_LENGTH:
+        return output
+    return "...\n" + output[-ISSUE_COMMENT_OUTPUT_LENGTH:]
+
+
 # TODO This should validate and sanitise the arguments before running the script
 def get_arguments(job_id, arg_infos, args):
     logger(f"Formatting and validating arguments for job {job_id}")
@@ -69,56 +233,139 @@ def get_arguments(job_id, arg_infos, args):
     return arg_list
 
 
-def run_script_and_close_issue(job, job_id, token):
+# The key to cache the result of this run of a read script under, or None if it shouldn't be cached (see result_cache.py)
+def get_result_cache_key(job, job_id, script_info, args, content_path):
+    if script_info["type"] != "read" or not script_info.get("cache_results", True) or not job.get("use_cache", True):
+        return None
+    try:
+        return get_cache_key(job["script_name"], job["subject"], script_info["arguments"], args, content_path)
+    except Exception as e:
+        logger(f"Failed to work out the result cache key for job {job_id}, not using the cache: {e}")
+        return None
+
+
+# A job whose result came from the cache didn't run its script, so give it the logs of the run the result came from: its
+# full output if that was saved with the result, or else as much of it as was kept
+def write_cached_job_logs(job_id, result, output_dir):
+    os.makedirs(get_job_log_dir(job_id), exist_ok=True)
+    full_output_path = f"{output_dir}/{FULL_OUTPUT_FILE_NAME}"
+    if os.path.exists(full_output_path):
+        shutil.copyfile(full_output_path, get_job_log_path(job_id, "stdout"))
+    else:
+        with open(get_job_log_path(job_id, "stdout"), "w") as f:
+            f.write(result["result"])
+    open(get_job_log_path(job_id, "stderr"), "w").close()
+
+
+def run_script_and_close_issue(job, job_id, token, content_path):
     script_info = SCRIPTS[job["script_name"]]
 
     args = get_arguments(job_id, script_info["arguments"], job["arguments"])
-    logger(f"Running script `{job['script_name']}` with args: {args}")
-    result = run_python_script(job["script_name"], job_id, job["subject"], args)
+    output_dir = f"{OUTPUT_PATH}/{job_id}"
+    # A rerun keeps its job id, so clear out what the last run of the job left in its output directory
+    set_aside_previous_output(job_id, output_dir)
+    cache_key = get_result_cache_key(job, job_id, script_info, args, content_path)
+    incremental_run = None
+    if cache_key and (result := load_cached_result(cache_key, output_dir)):
+        logger(f"Using the cached result of job {result['cached_from']} for job {job_id}")
+        write_cached_job_logs(job_id, result, output_dir)
+    else:
+        logger(f"Running script `{job['script_name']}` in {content_path} with args: {args}")
+        # Incremental scripts are told what has changed since they last ran (see incremental_runs.py), unless asked to
+        # run fresh
+        incremental_env = {}
+        if script_info.get("incremental"):
+            try:
+                # Note the content commit now, as a write script's checkout moves on once its changes are committed
+                incremental_run = {
+                    "arguments_hash": hash_arguments(script_info["arguments"], args),
+                    "content_sha": get_commit_sha(content_path, "HEAD"),
+                }
+                if job.get("use_cache", True):
+                    incremental_env = get_incremental_run_env(job["script_name"], job["subject"],
+                                                              incremental_run["arguments_hash"], content_path, job_id,
+                                                              logger=logger)
+            except Exception as e:
+                logger(f"Failed to work out the changes since the previous run for job {job_id}, running over the whole repo: {e}")
+        result = run_python_script(job["script_name"], job_id, job["subject"], args, content_path, extra_env=incremental_env)
+        # If the output is too long for the issue comment, it is uploaded (in full) along with any output files
+        stdout_path = get_job_log_path(job_id, "stdout")
+        if "error" not in result and os.path.getsize(stdout_path) > ISSUE_COMMENT_OUTPUT_LENGTH:
+            os.makedirs(output_dir, exist_ok=True)
+            shutil.copyfile(stdout_path, f"{output_dir}/{FULL_OUTPUT_FILE_NAME}")
+        if cache_key and "error" not in result:
+            try:
+                save_cached_result(cache_key, job_id, job["script_name"], job["subject"], result, output_dir)
+            except Exception as e:
+                logger(f"Failed to cache the result of job {job_id}: {e}")
     if "error" in result:
-        if comment(token, job_id, job["issue_number"],
-                   f"### Error running script:\n\n> {result['error']}\n\nPlease contact the team for assistance, quoting the job ID: {job_id}"):
-            update_job_status(job_id, JobRunStatus.FAILED, result, logger=logger)
+        if result.get("stop_reason") == JOB_LEASE_LOST_REASON:
+            logger(f"Job ID {job_id}: lease lost while running the script, leaving the job to whichever runner holds it now.")
+            return
+        # Scripts that were stopped have the reason recorded in the job itself
+        if stop_reason := result.pop("stop_reason", None):
+            message = f"### Script stopped:\n\n> {stop_reason}\n\nComment `Please rerun` to run it again, or contact the team for assistance, quoting the job ID: {job_id}"
+        else:
+            message = f"### Error running script:\n\n> {truncate_for_comment(result['error'])}\n\nPlease contact the team for assistance, quoting the job ID: {job_id}"
+        if comment(token, job_id, job["issue_number"], message):
+            update_claimed_job_status(job_id, JobRunStatus.FAILED, result, logger=logger)
         return
 
     logger(f"Script `{job['script_name']}` finished successfully")
+    if lease_lost_before(job_id, "publishing its results"):
+        return
+    # The job may have been cancelled after the script finished, or while it was being set up - don't publish its results
+    if stop_reason := get_job_stop_reason(job_id):
+        if comment(token, job_id, job["issue_number"],
+                   f"### Script stopped:\n\n> Cancelled: {stop_reason}\n\nComment `Please rerun` to run it again, or contact the team for assistance, quoting the job ID: {job_id}"):
+            update_claimed_job_status(job_id, JobRunStatus.FAILED, {"error": f"Cancelled: {stop_reason}"}, logger=logger)
+        return
     try:
         urls = []
         if script_info["type"] == "read":
             logger(f"Upload output files to GitHub for job {job_id} (if any)")
-            # Upload each output file to GitHub and get the URLs
-            if os.path.exists(f"{OUTPUT_PATH}/{job_id}"):
-                for f in os.listdir(f"{OUTPUT_PATH}/{job_id}"):
-                    response = upload_file_to_github(token, job_id, f"{OUTPUT_PATH}/{job_id}/{f}", f"{job_id}/{f}")
-                    response_json = response.json()
-                    if not response.status_code == 201 or "html_url" not in response_json["content"]:
-                        if comment(token, job_id, job["issue_number"],
-                                   f"### Error running script:\n\n> {response.text}\n\nPlease contact the team for assistance, quoting the job ID: {job_id}"):
-                            update_job_status(job_id, JobRunStatus.FAILED,
-                                              {"error": f"Failed to upload file: {response.text}"}, logger=logger)
-                        return
-                    urls.append({"file": f, "url": response_json["content"]["html_url"]})
+            # Upload the output files to GitHub (compressed, and skipping any uploaded before) and get the URLs
+            if os.path.exists(output_dir):
+                try:
+                    urls = upload_job_outputs(token, job_id, output_dir, logger=logger)
+                except Exception as e:
+                    if comment(token, job_id, job["issue_number"],
+                               f"### Error running script:\n\n> {e}\n\nPlease contact the team for assistance, quoting the job ID: {job_id}"):
+                        update_claimed_job_status(job_id, JobRunStatus.FAILED,
+                                          {"error": f"Failed to upload files: {e}"}, logger=logger)
+                    return
+        elif os.path.exists(f"{output_dir}/{FULL_OUTPUT_FILE_NAME}"):
+            # Other scripts' output files aren't uploaded, but their full output still needs to be
+            urls = upload_files_to_github(token, job_id, {FULL_OUTPUT_FILE_NAME: f"{output_dir}/{FULL_OUTPUT_FILE_NAME}"},
+                                          logger=logger)
 
         changes_link_text = ""
         if script_info["type"] == "write":
+            if lease_lost_before(job_id, "pushing its changes"):
+                return
             logger(f"Committing and pushing changes to GitHub for job {job_id}...")
             # Make a new branch and commit the changes, push to GitHub, and create a pull request
-            changes_result = new_branch_and_push_changes(DATA_PATH_MAP[job["subject"]], job_id)
+            if script_info.get("worktree"):
+                changes_result = commit_and_push_changes(content_path, job_id)
+            else:
+                changes_result = new_branch_and_push_changes(content_path, job_id)
             if changes_result["status"] == PushChangesStatus.FAILED:
                 if comment(token, job_id, job["issue_number"],
                            f"### Error creating pull request:\n\n> {changes_result['message']}\n\nPlease contact the team for assistance, quoting the job ID: {job_id}"):
-                    update_job_status(job_id, JobRunStatus.FAILED, {"error": changes_result["message"]}, logger=logger)
+                    update_claimed_job_status(job_id, JobRunStatus.FAILED, {"error": changes_result["message"]}, logger=logger)
                 return
             elif changes_result["status"] == PushChangesStatus.SUCCESS:
                 # Check if we should create a pull request
                 if "create_pull_request" in job and job["create_pull_request"]:
+                    if lease_lost_before(job_id, "creating a pull request"):
+                        return
                     logger(f"Creating pull request for job {job_id}...")
                     pr_result = create_pull_request(token, job_id, job["subject"], job["issue_number"])
                     pr_result_json = pr_result.json()
                     if "_links" not in pr_result_json or "html" not in pr_result_json["_links"] or "href" not in pr_result_json["_links"]["html"]:
                         if comment(token, job_id, job["issue_number"],
                                    f"### Error creating pull request:\n\nPlease contact the team for assistance, quoting the job ID: {job_id}"):
-                            update_job_status(job_id, JobRunStatus.FAILED, {"error": f"Failed to create pull request: response {pr_result_json}"}, logger=logger)
+                            update_claimed_job_status(job_id, JobRunStatus.FAILED, {"error": f"Failed to create pull request: response {pr_result_json}"}, logger=logger)
                         return
                     changes_link_text = f"\n\n### Changes\n\nPlease review and merge changes made by the script [here]({pr_result_json['_links']['html']['href']})."
                 else:
@@ -129,14 +376,26 @@ def run_script_and_close_issue(job, job_id, token):
 
         logger(f"Adding output to issue for job {job_id}...")
         # Add output to issue, and add a links to each output file
-        output = f"\n\n```\n{result['result']}\n```" if result["result"] else ""
+        output = f"\n\n```\n{truncate_for_comment(result['result'])}\n```" if result["result"] else ""
+        if os.path.exists(f"{output_dir}/{FULL_OUTPUT_FILE_NAME}"):
+            output += f"\n\nThe output was too long to show here in full - see `{FULL_OUTPUT_FILE_NAME}` below."
+        if "cached_from" in result:
+            output += (f"\n\nNothing has changed since this script was last run like this (job {result['cached_from']}), so "
+                       f"these are the results of that run. Comment `Please rerun fresh` to run it again anyway.")
         download_urls = "\n\n" + "\n".join([f"- [{url['file']}]({url['url']})" for url in urls])
         if comment(token, job_id, job["issue_number"], f"### Output{output}{download_urls}{changes_link_text}"):
-            update_job_status(job_id, JobRunStatus.FINISHED, result, logger=logger)
+            update_claimed_job_status(job_id, JobRunStatus.FINISHED, result, logger=logger)
+            # Only a run that finished is a starting point for the next incremental run
+            if incremental_run:
+                try:
+                    record_successful_run(job["script_name"], job["subject"], incremental_run["arguments_hash"],
+                                          incremental_run["content_sha"], job_id)
+                except Exception as e:
+                    logger(f"Failed to record the run of job {job_id} for incremental runs: {e}")
     except Exception as e:
         if comment(token, job_id, job["issue_number"],
                    f"### Error generating output files:\n\n> {str(e)}\n\nPlease contact the team for assistance, quoting the job ID: {job_id}.\n\nScript output:\n\n```{result['result']}```"):
-            update_job_status(job_id, JobRunStatus.FAILED, {"error": str(e)}, logger=logger)
+            update_claimed_job_status(job_id, JobRunStatus.FAILED, {"error": str(e)}, logger=logger)
 
 
 def ask_for_script_arguments(job, job_id, script_info, token):
@@ -175,11 +434,69 @@ Please reply to this comment with the argument, or delete this issue to cancel t
     else:
         message = f"### Error extracting script arguments:\n\nSomething went wrong. Please contact the team for assistance, quoting the job ID: {job_id}"
         if comment(token, job_id, job["issue_number"], message):
-            update_job_status(job_id, JobRunStatus.FAILED, {"error": f"Wrong argument type in arg object: {next_arg}"}, logger=logger)
+            update_claimed_job_status(job_id, JobRunStatus.FAILED, {"error": f"Wrong argument type in arg object: {next_arg}"}, logger=logger)
 
     # Add a comment to the issue asking for the next argument
     if comment(token, job_id, job["issue_number"], next_arg_message):
-        update_job_status(job_id, JobRunStatus.PAUSED, {"argument_index": next_arg_index}, logger=logger)
+        update_claimed_job_status(job_id, JobRunStatus.PAUSED, {"argument_index": next_arg_index}, logger=logger)
+
+
+# The number of jobs that may be running at once. Each job takes a slot before it is claimed, and gives it back when it
+# is done - or while it waits for a repo lock, so that jobs that can run aren't held up behind one that can't.
+job_executor_slots = threading.Semaphore(JOB_RUNNER_CONCURRENCY)
+
+
+# Passed as the `on_wait` of a repo lock, to give the job's executor slot up while it waits for the lock
+class ExecutorSlotYield:
+    def __init__(self):
+        self.waited = False
+
+    def __call__(self):
+        self.waited = True
+        job_executor_slots.release()
+
+    # Take a slot again (if it was given up) once the lock is held
+    def reclaim(self):
+        if self.waited:
+            self.waited = False
+            job_executor_slots.acquire()
+
+
+# Provides the content checkout a script should run against, and makes sure the scripts repo isn't updated while the
+# script runs from it. Other jobs may be running at the same time: read scripts share the main checkout (which isn't
+# updated while they run), and write scripts that opt in each get a worktree of their own. Other write scripts expect the
+# content at the shared checkout, so have it to themselves while they run. Nothing here holds up syncing the repos for
+# longer than it takes to create a worktree, except the locks on the shared checkouts (see repo_locks.py and
+# repo_sync.py). A job waiting for a lock doesn't take up an executor.
+@contextmanager
+def script_checkout(script_info, subject, job_id):
+    slot = ExecutorSlotYield()
+    with read_lock(SCRIPTS_PATH, on_wait=slot):
+        slot.reclaim()
+        with content_checkout(script_info, subject, job_id) as content_path:
+            yield content_path
+
+
+@contextmanager
+def content_checkout(script_info, subject, job_id):
+    repo_path = DATA_PATH_MAP[subject]
+    slot = ExecutorSlotYield()
+    if script_info["type"] == "write" and script_info.get("worktree"):
+        with job_worktree(repo_path, job_id, sparse_patterns=script_info.get("sparse_checkout"), on_lock_wait=slot,
+                          logger=logger) as worktree_path:
+            slot.reclaim()
+            yield worktree_path
+    elif script_info["type"] == "write":
+        with write_lock(repo_path, on_wait=slot):
+            slot.reclaim()
+            try:
+                yield repo_path
+            finally:
+                discard_changes(repo_path)
+    else:
+        with read_lock(repo_path, on_wait=slot):
+            slot.reclaim()
+            yield repo_path
 
 
 class GracefulKiller:
@@ -189,7 +506,7 @@ class GracefulKiller:
         signal.signal(signal.SIGINT, self.exit_gracefully)
         signal.signal(signal.SIGTERM, self.exit_gracefully)
 
-    def exit_gracefully(self):
+    def exit_gracefully(self, signum, frame):
         self.kill_now = True
 
 
@@ -199,13 +516,14 @@ def github_issue_confirm_job(job_id, job):
     # Get a GitHub token
     token = get_github_token(logger=logger)
 
-    # First make sure that the content repos are up to date
-    try:
-        logger(f"Updating content repos...")
-        pull_repos(token, logger=logger)
-    except Exception as e:
-        if comment(token, job_id, job["issue_number"], f"### Error pulling content repos:\n\n> {str(e)}\n\nPlease contact the team for assistance, quoting the job ID: {job_id}"):
-            update_job_status(job_id, JobRunStatus.FAILED, {"error": str(e)}, logger=logger)
+    # The repos are kept up to date in the background, so we only need to wait if one we use is being synced right now
+    logger("Waiting for any in-progress syncs of the scripts and content repos...")
+    repo_paths = [SCRIPTS_PATH] + ([DATA_PATH_MAP[job["subject"]]] if job["subject"] in DATA_PATH_MAP else [])
+    if not repo_syncer.wait_until_synced(repo_paths):
+        error = f"Timed out after {REPO_SYNC_WAIT_TIMEOUT} seconds waiting for the repos to sync"
+        logger(f"Job ID {job_id}: {error}.")
+        if comment(token, job_id, job["issue_number"], f"### Error running script:\n\n> {error}.\n\nComment `Please rerun` to try again, or contact the team for assistance, quoting the job ID: {job_id}"):
+            update_claimed_job_status(job_id, JobRunStatus.FAILED, {"error": error}, logger=logger)
         return
 
     # Add a reaction to the issue to show that we've seen it (if it's new)
@@ -214,13 +532,13 @@ def github_issue_confirm_job(job_id, job):
         logger(f"Adding initial reaction to issue for job {job_id}...")
         response = add_reaction_to_issue(token, job["issue_number"], "rocket")
         if not response.status_code == 201:
-            update_job_status(job_id, JobRunStatus.FAILED, {"error": f"Failed to add initial reaction: {response.text}"}, logger=logger)
+            update_claimed_job_status(job_id, JobRunStatus.FAILED, {"error": f"Failed to add initial reaction: {response.text}"}, logger=logger)
             return
 
     # Check if the script exists and the subject is valid
     if job["script_name"] not in SCRIPTS or job["subject"] not in ["phy", "ada"]:
         if comment(token, job_id, job["issue_number"], f"### Error running script:\n\n> Invalid script name or subject.\n\nPlease delete this issue and contact the team for assistance, quoting the job ID: {job_id}"):
-            update_job_status(job_id, JobRunStatus.FAILED, {"error": "Invalid script name or subject"}, logger=logger)
+            update_claimed_job_status(job_id, JobRunStatus.FAILED, {"error": "Invalid script name or subject"}, logger=logger)
         return
 
     script_info = SCRIPTS[job["script_name"]]
@@ -232,7 +550,8 @@ def github_issue_confirm_job(job_id, job):
     else:
         # Run the script
         logger("Script arguments complete, running script.")
-        run_script_and_close_issue(job, job_id, token)
+        with script_checkout(script_info, job["subject"], job_id) as content_path:
+            run_script_and_close_issue(job, job_id, token, content_path)
         # Remove input files
         logger("Script finished, removing any input files.")
         input_dir = f"{INPUT_PATH}/{job_id}"
@@ -247,38 +566,152 @@ JOB_HANDLERS = {
 
 # --- Main worker loop ---
 
-def process_job_queue():
-    killer = GracefulKiller()
-    logger("Starting up...")
-    # Get a GitHub token and pull the script and content repos on startup
-    token = get_github_token(logger=logger)
-    clone_if_needed(SCRIPTS_PATH, SCRIPTS_REPO_PATH, token, logger=logger)
-    pull_repos(token, logger=logger)
-    logger("Starting job queue processing loop.")
-    while not killer.kill_now:
-        # Get the next job from the queue, sleeping if there are none
-        job = get_next_job()
-        if not job:
-            # log_to_file("No jobs in queue, sleeping.")
-            time.sleep(NO_JOB_SLEEP_TIME)
-            continue
+# Keep renewing the lease on a job in the background while it is being handled, so that long-running scripts aren't
+# mistaken for crashed ones and re-queued. A renewal that fails (e.g. the database is busy) is retried at the next
+# interval, which leaves a few attempts before the lease runs out. If the lease has gone, the job's script is stopped.
+@contextmanager
+def keep_job_leased(job_id, worker_id):
+    stop = threading.Event()
+
+    def renew():
+        while not stop.wait(JOB_LEASE_RENEW_INTERVAL):
+            try:
+                renewed = renew_job_lease(job_id, worker_id)
+            except Exception as e:
+                logger(f"Job ID {job_id}: failed to renew lease, will retry: {e}")
+                continue
+            if not renewed:
+                logger(f"Job ID {job_id}: lease is no longer held by this runner, stopping the job.")
+                with script_stop_events_lock:
+                    lost_job_leases.add(job_id)
+                stop_running_script(job_id)
+                return
 
-        job_id = job["id"]
+    renewer = threading.Thread(target=renew, daemon=True)
+    renewer.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        renewer.join()
+        with script_stop_events_lock:
+            lost_job_leases.discard(job_id)
+
+
+# Archive old jobs and reclaim the space they used. Runs in the background in the job runner; each step is a short
+# transaction, so job claims are never held up for long.
+def run_housekeeping():
+    while True:
+        try:
+            archived = 0
+            while (batch := archive_old_jobs()) > 0:
+                archived += batch
+            if archived:
+                logger(f"Housekeeping: archived {archived} jobs older than {JOB_RETENTION_DAYS} days.")
+            while reclaim_free_pages() > 0:
+                time.sleep(0.1)
+            remove_old_job_logs(JOB_RETENTION_DAYS * 24 * 60 * 60, logger=logger)
+            if github_stats := github_client.format_stats():
+                logger(f"Housekeeping: GitHub API usage: {github_stats}")
+        except Exception as e:
+            logger(f"Error during housekeeping: {e}")
+        time.sleep(JOB_HOUSEKEEPING_INTERVAL)
 
-        logger(f"Job ID {job_id}: Processing job {job}.")
 
-        # Check we have a handler for the job type
-        if job["job_type"] not in JOB_HANDLERS:
-            update_job_status(job_id, JobRunStatus.FAILED, {"error": f"Unknown job type {job['job_type']}"})
-            continue
+def run_job(job, worker_id):
+    job_id = job["id"]
 
-        # Run the handler for this job type
-        try:
+    logger(f"Job ID {job_id}: Processing job {job}.")
+
+    # Check we have a handler for the job type
+    if job["job_type"] not in JOB_HANDLERS:
+        update_claimed_job_status(job_id, JobRunStatus.FAILED, {"error": f"Unknown job type {job['job_type']}"}, logger=logger)
+        return
+
+    # Run the handler for this job type
+    try:
+        with keep_job_leased(job_id, worker_id):
             JOB_HANDLERS[job["job_type"]](job_id, job)
-        except Exception as e:
-            logger(f"Error while running job handler: {e}")
-            update_job_status(job_id, JobRunStatus.FAILED, {"error": str(e)})
-            continue
+    except Exception as e:
+        logger(f"Error while running job handler: {e}")
+        update_claimed_job_status(job_id, JobRunStatus.FAILED, {"error": str(e)}, logger=logger)
+
+
+new_job_notified = threading.Event()
+
+
+# Handle notifications from the web workers: new jobs wake up the main loop, and pushes to our repos are synced
+def listen_for_notifications(listener):
+    while True:
+        for message in listener.wait(None):
+            if message.startswith(JOB_NOTIFY_CANCEL_PREFIX):
+                job_id = message[len(JOB_NOTIFY_CANCEL_PREFIX):]
+                logger(f"Job {job_id} has been cancelled, stopping its script if it is running.")
+                stop_running_script(job_id)
+            elif message.startswith(JOB_NOTIFY_SYNC_PREFIX):
+                repo_path = message[len(JOB_NOTIFY_SYNC_PREFIX):]
+                if repo_path in REPO_URL_MAP:
+                    logger(f"Repo {repo_path} has been pushed to, requesting sync.")
+                    repo_syncer.request_sync(repo_path)
+            else:
+                new_job_notified.set()
+
+
+def process_job_queue():
+    log_listener = start_logging()
+    killer = GracefulKiller()
+    worker_id = get_worker_id()
+    logger(f"Starting up as {worker_id} with {JOB_RUNNER_CONCURRENCY} job executors...")
+    # Start listening for notifications straight away, so none sent while we start up are missed
+    listener = JobNotificationListener()
+    # Get a GitHub token (and keep it fresh from now on), and pull the script and content repos on startup
+    get_github_token(logger=logger)
+    github_token_manager.start(logger=logger)
+    for repo_path, repo_url in REPO_URL_MAP.items():
+        if os.path.exists(repo_path):
+            configure_repo_credentials(repo_path, repo_url)
+    # A write script that was running when the runner stopped may have left changes in a shared checkout
+    for repo_path in DATA_PATH_MAP.values():
+        if os.path.exists(repo_path):
+            discard_changes(repo_path)
+    pull_repos(logger=logger)
+    try:
+        script_forkserver.start(logger=logger)
+    except OSError as e:
+        logger(f"Failed to start the script fork server, scripts will be started cold: {e}")
+    for repo_path in [SCRIPTS_PATH, *DATA_PATH_MAP.values()]:
+        prune_worktrees(repo_path, logger=logger)
+    repo_syncer.start(logger=logger)
+    threading.Thread(target=listen_for_notifications, args=(listener,), daemon=True).start()
+    threading.Thread(target=run_housekeeping, daemon=True).start()
+    logger("Starting job queue processing loop.")
+    # Only claim a job when there is an executor slot free to run it (see job_executor_slots), and a thread to run it
+    # on - jobs waiting for a repo lock keep their threads - so jobs we can't start yet stay claimable
+    max_jobs = JOB_RUNNER_CONCURRENCY + JOB_RUNNER_MAX_WAITING_JOBS
+    free_threads = threading.Semaphore(max_jobs)
+
+    def job_done(_):
+        job_executor_slots.release()
+        free_threads.release()
+
+    with ThreadPoolExecutor(max_workers=max_jobs, thread_name_prefix="job-executor") as executor:
+        while not killer.kill_now:
+            free_threads.acquire()
+            job_executor_slots.acquire()
+            # Get the next job from the queue, waiting to be notified of a new one if there are none. The flag is
+            # cleared before looking, so a notification that arrives while we look isn't lost.
+            new_job_notified.clear()
+            job = get_next_job(worker_id)
+            if not job:
+                job_executor_slots.release()
+                free_threads.release()
+                new_job_notified.wait(JOB_FALLBACK_POLL_INTERVAL)
+                continue
+            executor.submit(run_job, job, worker_id).add_done_callback(job_done)
+    logger("Job queue processing loop stopped.")
+    script_forkserver.stop()
+    # Write out anything still queued before the process exits
+    log_listener.stop()
 
 
 def init_worker_process():
@@ -0,0 +1,75 @@
+"""
+The stage between a read script finishing and its output files being uploaded to GitHub.
+
+Scripts such as image_list and question_list regenerate large CSVs that are often identical from one run to the next.
+Each output file is hashed, and if a file with the same contents has been uploaded before, the job links to that upload
+rather than uploading it again (uploads are linked by commit, so the earlier link stays valid). Other files of at least
+OUTPUT_COMPRESSION_THRESHOLD bytes are gzipped before they are uploaded, unless they are in a compressed format already.
+"""
+import gzip
+import hashlib
+import os
+import shutil
+import tempfile
+
+from constants import *
+from db_logic import get_output_artifact, save_output_artifact
+from git_logic import upload_files_to_github
+
+
+def hash_file(file_path):
+    content_hash = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        while chunk := f.read(GITHUB_UPLOAD_CHUNK_SIZE):
+            content_hash.update(chunk)
+    return content_hash.hexdigest()
+
+
+def should_compress(file_name, size):
+    return size >= OUTPUT_COMPRESSION_THRESHOLD and os.path.splitext(file_name)[1].lower() not in OUTPUT_COMPRESSED_EXTENSIONS
+
+
+def compress_file(file_path, compressed_path):
+    # mtime=0 so compressing the same contents always gives the same bytes
+    with open(file_path, "rb") as f_in, open(compressed_path, "wb") as f_out:
+        with gzip.GzipFile(fileobj=f_out, mode="wb", mtime=0) as gz_out:
+            shutil.copyfileobj(f_in, gz_out, GITHUB_UPLOAD_CHUNK_SIZE)
+
+
+# Upload the output files of job `job_id` (the files in `output_dir`) to GitHub, compressing and deduplicating them as
+# described above, and return a list of {"file", "url"} for them
+def upload_job_outputs(token, job_id, output_dir, logger=lambda x: None):
+    file_names = sorted(f for f in os.listdir(output_dir) if os.path.isfile(f"{output_dir}/{f}"))
+    urls = {}
+    # Uploaded name -> (file name, path of the file to upload, content hash, original size)
+    to_upload = {}
+    with tempfile.TemporaryDirectory(prefix=f"{job_id}-") as compressed_dir:
+        for f in file_names:
+            file_path = f"{output_dir}/{f}"
+            size = os.path.getsize(file_path)
+            content_hash = hash_file(file_path)
+            if artifact := get_output_artifact(content_hash):
+                logger(f"Output file {f} for job {job_id} is unchanged from an earlier upload, reusing it")
+                urls[f] = artifact["url"]
+                continue
+
+            if should_compress(f, size):
+                compressed_path = f"{compressed_dir}/{f}.gz"
+                compress_file(file_path, compressed_path)
+                compressed_size = os.path.getsize(compressed_path)
+                if compressed_size < size:
+                    logger(f"Compressed output file {f} for job {job_id} from {size / 1e6:.2f}MB to {compressed_size / 1e6:.2f}MB")
+                    to_upload[f"{f}.gz"] = (f, compressed_path, content_hash, size)
+                    continue
+            to_upload[f] = (f, file_path, content_hash, size)
+
+        if to_upload:
+            uploaded = upload_files_to_github(token, job_id, {name: path for name, (_, path, _, _) in to_upload.items()},
+                                              logger=logger)
+            for upload in uploaded:
+                f, path, content_hash, size = to_upload[upload["file"]]
+                save_output_artifact(content_hash, upload["url"], size, os.path.getsize(path))
+                urls[f] = upload["url"]
+
+    # Name the link after the file the user will actually download, which may be the compressed one
+    return [{"file": f"{f}.gz" if urls[f].endswith(".gz") and not f.endswith(".gz") else f, "url": urls[f]} for f in file_names]
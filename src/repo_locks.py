@@ -0,0 +1,83 @@
+"""
+Per-repository read/write locks for the job runner's executor threads.
+
+Any number of jobs may read from a repository checkout at once (e.g. read-only scripts), but anything that changes the
+checkout (updating it to a new commit, or a write script editing it in place) needs it to itself.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+from constants import *
+
+
+class ReadWriteLock:
+    # A writer that has been waiting for `priority_after` seconds holds up new readers, so that it can't be starved by a
+    # steady stream of them. Write scripts have priority straight away; a sync only after a while, so that one waiting
+    # for a long-running script to finish doesn't hold up every new job as well (see update_repo).
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._readers = 0
+        self._writer = False
+        self._priority_writers_waiting = 0
+
+    # `on_wait` is called (once) if the lock can't be had straight away, before waiting for it
+    def acquire_read(self, on_wait=lambda: None):
+        with self._condition:
+            if self._writer or self._priority_writers_waiting:
+                on_wait()
+            while self._writer or self._priority_writers_waiting:
+                self._condition.wait()
+            self._readers += 1
+
+    def release_read(self):
+        with self._condition:
+            self._readers -= 1
+            if self._readers == 0:
+                self._condition.notify_all()
+
+    def acquire_write(self, priority_after=0, on_wait=lambda: None):
+        deadline = time.monotonic() + priority_after
+        has_priority = False
+        with self._condition:
+            if self._writer or self._readers:
+                on_wait()
+            try:
+                while self._writer or self._readers:
+                    if not has_priority and time.monotonic() >= deadline:
+                        has_priority = True
+                        self._priority_writers_waiting += 1
+                    self._condition.wait(None if has_priority else deadline - time.monotonic())
+                self._writer = True
+            finally:
+                if has_priority:
+                    self._priority_writers_waiting -= 1
+                    self._condition.notify_all()
+
+    def release_write(self):
+        with self._condition:
+            self._writer = False
+            self._condition.notify_all()
+
+
+REPO_LOCKS = {path: ReadWriteLock() for path in [SCRIPTS_PATH, PHY_DATA_PATH, CS_DATA_PATH]}
+
+
+@contextmanager
+def read_lock(repo_path, on_wait=lambda: None):
+    lock = REPO_LOCKS[repo_path]
+    lock.acquire_read(on_wait=on_wait)
+    try:
+        yield
+    finally:
+        lock.release_read()
+
+
+@contextmanager
+def write_lock(repo_path, priority_after=0, on_wait=lambda: None):
+    lock = REPO_LOCKS[repo_path]
+    lock.acquire_write(priority_after=priority_after, on_wait=on_wait)
+    try:
+        yield
+    finally:
+        lock.release_write()
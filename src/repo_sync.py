@@ -0,0 +1,90 @@
+"""
+Background syncing of the content and scripts repos in the job runner.
+
+Rather than every job paying to bring the repos up to date before it runs, a background thread syncs a repo as soon as
+GitHub tells us it has been pushed to (the web workers pass push webhooks on to the runner, see job_notify.py), and
+checks all of them every REPO_SYNC_INTERVAL seconds in case a webhook is missed. Jobs then only have to wait if a sync
+of a repo they use is actually queued or in progress.
+
+Each repo is synced by a thread of its own, so a slow sync of one repo doesn't hold up the others. A sync only needs the
+repo's write lock to update the checkout (see update_repo), which it can't get while a job is running a script against
+it, so jobs don't wait for a sync that is waiting for the lock - they run against the checkout as it is instead (until
+the sync has waited REPO_SYNC_LOCK_PRIORITY_AFTER seconds, see ReadWriteLock).
+"""
+import os
+import threading
+import time
+
+from constants import *
+from git_logic import timed_sync_repo
+from github_auth import get_github_token
+
+
+class RepoSyncer:
+    def __init__(self):
+        self._condition = threading.Condition()
+        # Repo path -> the max_age to sync it with (0 forces a check against the remote)
+        self._pending = {}
+        self._in_flight = set()
+        # Repos whose sync is waiting for the repo's write lock
+        self._waiting_for_lock = set()
+
+    def request_sync(self, repo_path, max_age=0):
+        with self._condition:
+            self._pending[repo_path] = min(max_age, self._pending.get(repo_path, max_age))
+            self._condition.notify_all()
+
+    def _is_syncing(self, repo_path):
+        if repo_path in self._waiting_for_lock:
+            return False
+        return repo_path in self._pending or repo_path in self._in_flight
+
+    # Block until none of `repo_paths` are waiting to be synced, or being synced (other than waiting for the lock).
+    # Returns False if that takes longer than `timeout` seconds
+    def wait_until_synced(self, repo_paths, timeout=REPO_SYNC_WAIT_TIMEOUT):
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: not any(self._is_syncing(repo_path) for repo_path in repo_paths), timeout=timeout)
+
+    def _on_lock_wait(self, repo_path):
+        with self._condition:
+            self._waiting_for_lock.add(repo_path)
+            self._condition.notify_all()
+
+    def run_repo(self, repo_path, logger=lambda x: None):
+        while True:
+            with self._condition:
+                while repo_path not in self._pending:
+                    self._condition.wait()
+                max_age = self._pending.pop(repo_path)
+                self._in_flight.add(repo_path)
+
+            try:
+                # Make sure git has a token to use (see github_auth.py) that won't expire part way through
+                get_github_token(logger=logger)
+                timed_sync_repo(repo_path, logger=logger, max_age=max_age,
+                                on_lock_wait=lambda: self._on_lock_wait(repo_path))
+            except Exception as e:
+                logger(f"Error syncing repo {repo_path}: {e}")
+            finally:
+                with self._condition:
+                    self._in_flight.discard(repo_path)
+                    self._waiting_for_lock.discard(repo_path)
+                    self._condition.notify_all()
+
+    def run_periodic(self):
+        while True:
+            time.sleep(REPO_SYNC_INTERVAL)
+            with self._condition:
+                for repo_path in REPO_URL_MAP:
+                    self._pending.setdefault(repo_path, REPO_FRESHNESS_WINDOW)
+                self._condition.notify_all()
+
+    def start(self, logger=lambda x: None):
+        for repo_path in REPO_URL_MAP:
+            threading.Thread(target=self.run_repo, args=(repo_path,), kwargs={"logger": logger}, daemon=True,
+                             name=f"repo-syncer-{os.path.basename(repo_path)}").start()
+        threading.Thread(target=self.run_periodic, daemon=True, name="repo-syncer-periodic").start()
+
+
+repo_syncer = RepoSyncer()
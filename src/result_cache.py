@@ -0,0 +1,92 @@
+"""
+Cache of read scripts' results.
+
+A read script's result (its output, and any output files) depends only on the script, the subject, its arguments, and
+the commits of the content and scripts repos it ran against - so if someone runs the same script again before any of
+those change, the saved result is given to them straight away rather than running the script from scratch. Arguments
+that are files are keyed on their contents rather than their (per-job) paths.
+
+Each result is saved in its own directory under RESULT_CACHE_PATH, recorded in the result_cache table. Once the saved
+results take up more than RESULT_CACHE_MAX_SIZE bytes, the least recently used are evicted. A job can skip the cache
+(e.g. if a script depends on something outside the repos) - see the "Please rerun fresh" command in app.py.
+"""
+import hashlib
+import json
+import os
+import shutil
+
+from constants import *
+from db_logic import save_result_cache_entry, use_result_cache_entry, delete_result_cache_entry, \
+    get_result_cache_keys_over_budget
+from git_logic import get_commit_sha
+from output_artifacts import hash_file
+
+
+# A hash of a script's arguments, with file arguments standing for their contents rather than their (per-job) paths.
+# `args` is the command line built by get_arguments in job_queue.py: a `--param value` pair for each of `arg_infos`.
+def hash_arguments(arg_infos, args):
+    values = args[1::2]
+    if len(args) != 2 * len(arg_infos):
+        raise ValueError(f"Expected {len(arg_infos)} arguments, got {args}")
+    arguments = [hash_file(value) if arg_info["type"] == "file" else value for arg_info, value in zip(arg_infos, values)]
+    return hashlib.sha256(json.dumps(arguments).encode()).hexdigest()
+
+
+def get_cache_key(script_name, subject, arg_infos, args, content_path):
+    key = {
+        "script_name": script_name,
+        "subject": subject,
+        "arguments": hash_arguments(arg_infos, args),
+        "content_sha": get_commit_sha(content_path, "HEAD"),
+        "scripts_sha": get_commit_sha(SCRIPTS_PATH, "HEAD"),
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def get_cache_entry_path(cache_key):
+    return f"{RESULT_CACHE_PATH}/{cache_key}"
+
+
+# Look up the saved result for `cache_key`. If there is one, copy its output files into `output_dir` (as if the script
+# had just written them) and return the result, otherwise return None.
+def load_cached_result(cache_key, output_dir):
+    entry = use_result_cache_entry(cache_key)
+    if entry is None:
+        return None
+    entry_path = get_cache_entry_path(cache_key)
+    if not os.path.isdir(entry_path):
+        # The entry's files have gone missing, so it is no use to anyone
+        delete_result_cache_entry(cache_key)
+        return None
+
+    with open(f"{entry_path}/result.txt") as f:
+        result = f.read()
+    if os.path.isdir(f"{entry_path}/outputs"):
+        shutil.copytree(f"{entry_path}/outputs", output_dir, dirs_exist_ok=True)
+    return {"result": result, "cached_from": entry["job_id"]}
+
+
+# Save the `result` of job `job_id`, and the output files it wrote to `output_dir`, under `cache_key`
+def save_cached_result(cache_key, job_id, script_name, subject, result, output_dir):
+    entry_path = get_cache_entry_path(cache_key)
+    # Build the entry to one side and move it into place, so a half-saved entry is never seen
+    temp_path = f"{RESULT_CACHE_PATH}/.{job_id}"
+    shutil.rmtree(temp_path, ignore_errors=True)
+    os.makedirs(temp_path)
+    with open(f"{temp_path}/result.txt", "w") as f:
+        f.write(result["result"])
+    if os.path.isdir(output_dir):
+        shutil.copytree(output_dir, f"{temp_path}/outputs")
+    size = sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(temp_path) for name in names)
+
+    shutil.rmtree(entry_path, ignore_errors=True)
+    os.rename(temp_path, entry_path)
+    save_result_cache_entry(cache_key, job_id, script_name, subject, size)
+    evict_cached_results()
+
+
+def evict_cached_results(max_size=RESULT_CACHE_MAX_SIZE, logger=lambda x: None):
+    for cache_key in get_result_cache_keys_over_budget(max_size):
+        logger(f"Evicting cached result {cache_key}")
+        delete_result_cache_entry(cache_key)
+        shutil.rmtree(get_cache_entry_path(cache_key), ignore_errors=True)
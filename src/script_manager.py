@@ -2,6 +2,8 @@
     Script manager - contains information about all scripts and provides helpers to get particular info.
     Needs to be updated when new scripts are added - this could be automated in future perhaps.
 """
+from constants import *
+
 
 GOOGLE_DOC_PUBLISH_HOW_TO = """
 To publish a Google Sheet CSV so the script can access it, follow these steps:
@@ -18,11 +20,17 @@ You can unpublish the sheet after the script has finished running.
 
 """
 
+# Read scripts that make a single pass over the repo finish in minutes, so if one runs for more than half an hour
+# something has gone wrong - stop it, rather than let it take up a job executor for the default two hours
+QUICK_READ_SCRIPT_LIMITS = {"timeout": 30 * 60, "cpu_time": 30 * 60}
+
 SCRIPTS = {
     "list_question_data": {
         "description": "Lists paths, ids and related content for question pages",
         "arguments": [],
-        "type": "read"
+        "type": "read",
+        "content_index": True,
+        "limits": QUICK_READ_SCRIPT_LIMITS
     },
     "link_checker": {
         "description": "Checks links across the content repository",
@@ -35,7 +43,10 @@ SCRIPTS = {
                 "example": "/pages/about_us;/pages/another_new_page;/questions/a_question_id"
             }
         ],
-        "type": "read"
+        "type": "read",
+        "content_index": True,
+        # Waits on every external site linked to, so can take a long time without doing much itself
+        "limits": {"timeout": 4 * 60 * 60, "cpu_time": 60 * 60}
     },
     "find_broken_image_links": {
         "description": """
@@ -44,12 +55,15 @@ figure sources are relative paths, so if figure sources point to the CDN for exa
 will flag them up as "broken".
         """,
         "arguments": [],
-        "type": "read"
+        "type": "read",
+        "content_index": True
     },
     "compress_svgs": {
         "description": "Compresses all SVGs in the content repository",
         "arguments": [],
-        "type": "write"
+        "type": "write",
+        # Recompresses every SVG in the repo, which is CPU-bound and takes longer than most scripts
+        "limits": {"timeout": 4 * 60 * 60, "cpu_time": 4 * 60 * 60}
     },
     "image_renaming": {
         "description": "Renames images in the content repository",
@@ -68,12 +82,16 @@ will flag them up as "broken".
     "image_list": {
         "description": "Lists all images in the content repository",
         "arguments": [],
-        "type": "read"
+        "type": "read",
+        "content_index": True,
+        "limits": QUICK_READ_SCRIPT_LIMITS
     },
     "image_duplicates": {
         "description": "Dedupe images in the content repository",
         "arguments": [],
-        "type": "write"
+        "type": "write",
+        # Reads every image in the repo (and holds their hashes in memory)
+        "limits": {"timeout": 3 * 60 * 60, "cpu_time": 3 * 60 * 60}
     },
     "image_attribution": {
         "description": "Applies attribution to images in the content repository",
@@ -92,17 +110,21 @@ will flag them up as "broken".
     "question_list": {
         "description": "Gives detailed data about all questions in the content repository",
         "arguments": [],
-        "type": "read"
+        "type": "read",
+        "content_index": True
     },
     "topics_concepts": {
         "description": "Gives detailed data about all topic and concept pages in the content repository",
         "arguments": [],
-        "type": "read"
+        "type": "read",
+        "content_index": True,
+        "limits": QUICK_READ_SCRIPT_LIMITS
     },
     "topics_accordions": {
         "description": "Gives detailed data about all accordion sections on topic pages in the content repository",
         "arguments": [],
-        "type": "read"
+        "type": "read",
+        "limits": QUICK_READ_SCRIPT_LIMITS
     }
 }
 
@@ -111,3 +133,13 @@ def get_script_arguments(script_name):
     if script_name in SCRIPTS:
         return SCRIPTS[script_name]["arguments"]
     return None
+
+
+# Whether the script is given the content index (see content_index.py), which is only built for scripts that use it
+def script_uses_content_index(script_name):
+    return SCRIPTS[script_name].get("content_index", False)
+
+
+# The limits on a run of the script (see DEFAULT_SCRIPT_LIMITS), which can be overridden by its "limits" entry
+def get_script_limits(script_name):
+    return {**DEFAULT_SCRIPT_LIMITS, **SCRIPTS[script_name].get("limits", {})}
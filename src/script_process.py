@@ -0,0 +1,321 @@
+"""
+Starting scripts' processes.
+
+Starting a fresh interpreter for every job means paying for interpreter start-up and for importing the same libraries
+(scour, requests, CSV and JSON handling, ...) every time, which for short scripts is most of their run. Instead, the job
+runner keeps a fork server: an interpreter that has already imported SCRIPT_FORKSERVER_PRELOAD_MODULES and waits on
+SCRIPT_FORKSERVER_SOCKET_PATH. For each script it is sent the script's path, arguments, environment and limits, along
+with the file descriptors of its log files, and forks a child that runs the script (with runpy, as `python script.py`
+would). Every script still gets a process of its own, in a session of its own, so it can't affect other jobs and can
+be killed along with anything it starts - just as when it is started cold.
+
+The fork server only ever runs one thread, so forking it is safe, unlike forking the (multithreaded) job runner. It
+exits when the job runner does. Scripts marked "warm": False in SCRIPTS (e.g. ones that depend on a fresh interpreter's
+state), and any started while the fork server is unavailable, are started cold with subprocess as before.
+"""
+import atexit
+import functools
+import importlib
+import json
+import os
+import resource
+import runpy
+import select
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import traceback
+
+from constants import *
+
+
+# Runs in the script's process, just before the script starts. Only makes system calls, as when starting a script cold
+# it mustn't touch anything another of the runner's threads might have been holding a lock on when the process forked.
+def set_script_limits(limits):
+    # The kernel sends SIGXCPU at the soft limit, which is how we tell the script was stopped for using too much CPU
+    # time. The hard limit (SIGKILL) is only reached if the script ignores that.
+    resource.setrlimit(resource.RLIMIT_CPU, (limits["cpu_time"], limits["cpu_time"] + SCRIPT_CPU_TIME_GRACE))
+    resource.setrlimit(resource.RLIMIT_AS, (limits["memory"], limits["memory"]))
+    resource.setrlimit(resource.RLIMIT_FSIZE, (limits["max_output"], limits["max_output"]))
+
+
+# The runner's environment, less what scripts mustn't see: the GitHub token for git (see github_auth.py), which only the
+# runner's own git commands need
+def get_script_base_env():
+    return {name: value for name, value in os.environ.items() if name != GIT_TOKEN_ENV_VAR}
+
+
+# Start `script_path` with `args` in a fresh interpreter, writing its output to the files `stdout` and `stderr`. The
+# script gets a process group of its own, so it can be killed along with anything it starts.
+def start_cold_script(script_path, args, stdout, stderr, env, limits):
+    return subprocess.Popen(
+        ["python", script_path, *args],
+        stdout=stdout,
+        stderr=stderr,
+        env=env,
+        start_new_session=True,
+        preexec_fn=functools.partial(set_script_limits, limits),
+    )
+
+
+# Start a script (see start_cold_script), from the fork server if `warm`, falling back to starting it cold if that fails.
+# Either way, the process returned can be waited on and killed like a subprocess.Popen.
+def start_script(script_path, args, stdout, stderr, env, limits, warm=True, logger=lambda x: None):
+    if warm:
+        try:
+            return script_forkserver.run(script_path, args, stdout, stderr, env, limits, logger=logger)
+        except (OSError, ValueError) as e:
+            logger(f"Couldn't start {os.path.basename(script_path)} from the fork server, starting it cold: {e}")
+    return start_cold_script(script_path, args, stdout, stderr, env, limits)
+
+
+# A script started by the fork server. The fork server tells us its pid once it has started, and its exit status once
+# it has finished, over the connection it was started through.
+class WarmScriptProcess:
+    def __init__(self, args, conn, pid):
+        self.args = args
+        self.conn = conn
+        self.pid = pid
+        self.returncode = None
+
+    def wait(self, timeout=None):
+        if self.returncode is not None:
+            return self.returncode
+        self.conn.settimeout(timeout)
+        try:
+            message = self.conn.recv(SCRIPT_FORKSERVER_MAX_MESSAGE_SIZE)
+        except socket.timeout:
+            raise subprocess.TimeoutExpired(self.args, timeout)
+        if message:
+            self.returncode = json.loads(message)["returncode"]
+        else:
+            # The fork server has gone without telling us how the script finished - make sure it has
+            try:
+                os.killpg(self.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            self.returncode = -signal.SIGKILL
+        self.conn.close()
+        return self.returncode
+
+
+# The job runner's handle on the fork server process, which is restarted if it dies
+class ScriptForkServer:
+    def __init__(self, socket_path=SCRIPT_FORKSERVER_SOCKET_PATH):
+        self.socket_path = os.path.abspath(socket_path)
+        self.process = None
+        self.lock = threading.Lock()
+
+    def start(self, logger=lambda x: None):
+        with self.lock:
+            self._start(logger)
+
+    def _start(self, logger):
+        logger("Starting the script fork server...")
+        # The fork server exits when its stdin closes, i.e. when the job runner exits. It has a session of its own so
+        # that signals meant for the runner (e.g. Ctrl-C) don't reach it, or the scripts it is running.
+        self.process = subprocess.Popen(
+            ["python", os.path.abspath(__file__), self.socket_path, *SCRIPT_FORKSERVER_PRELOAD_MODULES],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            env=get_script_base_env(),
+            start_new_session=True,
+        )
+        # It says when it is listening, having imported everything
+        ready = self.process.stdout.readline().decode().strip()
+        if not ready:
+            self.process.wait()
+            raise OSError(f"The script fork server exited on startup with code {self.process.returncode}")
+        logger(f"Script fork server started ({ready}).")
+
+    def stop(self):
+        with self.lock:
+            if self.process is not None:
+                self.process.stdin.close()
+                self.process.wait()
+                self.process = None
+
+    def run(self, script_path, args, stdout, stderr, env, limits, logger=lambda x: None):
+        with self.lock:
+            if self.process is None:
+                raise OSError("The script fork server isn't running")
+            if self.process.poll() is not None:
+                logger(f"The script fork server exited with code {self.process.returncode}, restarting it")
+                self._start(logger)
+
+        request = {
+            "script_path": os.path.abspath(script_path),
+            "args": args,
+            "env": env,
+            "limits": limits,
+            "cwd": os.getcwd(),
+        }
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        try:
+            conn.connect(self.socket_path)
+            socket.send_fds(conn, [json.dumps(request).encode("utf-8")], [stdout.fileno(), stderr.fileno()])
+            message = conn.recv(SCRIPT_FORKSERVER_MAX_MESSAGE_SIZE)
+            if not message:
+                raise OSError("The script fork server closed the connection")
+            reply = json.loads(message)
+            if "error" in reply:
+                raise OSError(reply["error"])
+        except BaseException:
+            conn.close()
+            raise
+        return WarmScriptProcess([script_path, *args], conn, reply["pid"])
+
+
+script_forkserver = ScriptForkServer()
+
+
+# --- The fork server itself ---
+
+# Runs in the forked child: set the script's process up as `python script_path args...` would be, run it, and exit
+def run_script_in_child(request, stdout_fd, stderr_fd, started_fd):
+    exit_code = 1
+    try:
+        os.setsid()
+        # Only now can the script be killed by its process group, so only now say it has started
+        os.write(started_fd, b"1")
+        os.close(started_fd)
+        set_script_limits(request["limits"])
+
+        stdin_fd = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(stdin_fd, 0)
+        os.dup2(stdout_fd, 1)
+        os.dup2(stderr_fd, 2)
+        for fd in [stdin_fd, stdout_fd, stderr_fd]:
+            os.close(fd)
+        os.chdir(request["cwd"])
+        os.environ.clear()
+        os.environ.update(request["env"])
+
+        # The script mustn't see the fork server's own modules (e.g. constants), only the libraries it preloaded
+        server_dir = os.path.dirname(os.path.abspath(__file__))
+        for name, module in list(sys.modules.items()):
+            if name != "__main__" and os.path.dirname(getattr(module, "__file__", None) or "") == server_dir:
+                del sys.modules[name]
+        sys.argv = [request["script_path"], *request["args"]]
+        sys.path[0] = os.path.dirname(request["script_path"])
+        runpy.run_path(request["script_path"], run_name="__main__")
+        exit_code = 0
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            exit_code = e.code or 0
+        else:
+            print(e.code, file=sys.stderr)
+    except BaseException as e:
+        # Leave out the fork server's and runpy's frames, so the traceback looks as it would from `python script.py`
+        tb = e.__traceback__
+        while tb is not None and tb.tb_frame.f_code.co_filename != request["script_path"]:
+            tb = tb.tb_next
+        traceback.print_exception(type(e), e, tb or e.__traceback__)
+    finally:
+        try:
+            atexit._run_exitfuncs()
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(exit_code)
+
+
+# Fork a child to run the script requested on `conn`, returning its pid. The child closes the fork server's own sockets
+# and file descriptors, `server_sockets` and `server_fds`.
+def fork_script(conn, server_sockets, server_fds):
+    message, fds, _, _ = socket.recv_fds(conn, SCRIPT_FORKSERVER_MAX_MESSAGE_SIZE, 2)
+    try:
+        if len(fds) != 2:
+            raise ValueError(f"Expected the script's stdout and stderr, got {len(fds)} file descriptors")
+        request = json.loads(message)
+        started_r, started_w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(started_r)
+            signal.set_wakeup_fd(-1)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            for sock in server_sockets:
+                sock.close()
+            for fd in server_fds:
+                os.close(fd)
+            run_script_in_child(request, fds[0], fds[1], started_w)
+        os.close(started_w)
+        os.read(started_r, 1)
+        os.close(started_r)
+        return pid
+    finally:
+        for fd in fds:
+            os.close(fd)
+
+
+def send_message(conn, message):
+    try:
+        conn.send(json.dumps(message).encode("utf-8"))
+    except OSError:
+        # The job runner has stopped waiting for the script
+        pass
+
+
+def serve(socket_path, preload_modules):
+    preloaded = []
+    for module in preload_modules:
+        try:
+            importlib.import_module(module)
+            preloaded.append(module)
+        except ImportError:
+            pass
+
+    # Wake up as soon as a script finishes, as well as when the job runner asks for one to be started
+    wakeup_r, wakeup_w = os.pipe()
+    os.set_blocking(wakeup_r, False)
+    os.set_blocking(wakeup_w, False)
+    signal.set_wakeup_fd(wakeup_w)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    server.bind(socket_path)
+    server.listen()
+    print(f"pid {os.getpid()}, preloaded {', '.join(preloaded) or 'nothing'}", flush=True)
+
+    # The connection each running script was started through, by pid
+    connections = {}
+    while True:
+        readable, _, _ = select.select([0, server, wakeup_r], [], [])
+        if 0 in readable and not os.read(0, 1024):
+            # The job runner has exited
+            break
+        if wakeup_r in readable:
+            while True:
+                try:
+                    if not os.read(wakeup_r, 1024):
+                        break
+                except BlockingIOError:
+                    break
+        if server in readable:
+            conn, _ = server.accept()
+            try:
+                pid = fork_script(conn, [server, conn, *connections.values()], [wakeup_r, wakeup_w])
+                connections[pid] = conn
+                send_message(conn, {"pid": pid})
+            except Exception as e:
+                send_message(conn, {"error": f"Failed to start script: {e}"})
+                conn.close()
+
+        while connections:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                break
+            if conn := connections.pop(pid, None):
+                send_message(conn, {"returncode": os.waitstatus_to_exitcode(status)})
+                conn.close()
+
+    server.close()
+    os.unlink(socket_path)
+
+
+if __name__ == "__main__":
+    serve(sys.argv[1], sys.argv[2:])
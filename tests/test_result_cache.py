@@ -0,0 +1,37 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from result_cache import hash_arguments  # noqa: E402
+
+TEXT_ARGUMENTS = [{"param": "eps", "type": "text"}]
+FILE_ARGUMENTS = [{"param": "csv", "type": "file", "file_type": "csv"}]
+
+
+def test_text_argument_values_are_part_of_the_hash():
+    assert hash_arguments(TEXT_ARGUMENTS, ["--eps", "/pages/a"]) != hash_arguments(TEXT_ARGUMENTS, ["--eps", "/pages/b;/pages/c"])
+    assert hash_arguments(TEXT_ARGUMENTS, ["--eps", "/pages/a"]) == hash_arguments(TEXT_ARGUMENTS, ["--eps", "/pages/a"])
+
+
+def test_file_arguments_are_hashed_by_contents(tmp_path):
+    first, second, different = tmp_path / "first.csv", tmp_path / "second.csv", tmp_path / "different.csv"
+    first.write_text("a,b\n1,2\n")
+    second.write_text("a,b\n1,2\n")
+    different.write_text("a,b\n3,4\n")
+
+    assert hash_arguments(FILE_ARGUMENTS, ["--csv", str(first)]) == hash_arguments(FILE_ARGUMENTS, ["--csv", str(second)])
+    assert hash_arguments(FILE_ARGUMENTS, ["--csv", str(first)]) != hash_arguments(FILE_ARGUMENTS, ["--csv", str(different)])
+
+
+def test_no_arguments_hash_differently_to_an_empty_argument():
+    assert hash_arguments([], []) != hash_arguments(TEXT_ARGUMENTS, ["--eps", ""])
+
+
+def test_mismatched_arguments_are_rejected():
+    with pytest.raises(ValueError):
+        hash_arguments(TEXT_ARGUMENTS, [])
+    with pytest.raises(ValueError):
+        hash_arguments([], ["--eps", "/pages/a"])